@@ -0,0 +1,82 @@
+"""Benchmark of `mypyutils.dict.deep_copy`/`deep_update` against the previous recursive implementations.
+
+Usage: python benchmarks/dict_update.py
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from mypyutils.dict import deep_copy, deep_update
+
+def legacy_deep_copy(old):
+    res = {}
+    for k,v in old.items():
+        if not isinstance(v, dict):
+            res[k] = v
+        else:
+            res[k] = legacy_deep_copy(v)
+
+    return res
+
+def legacy_deep_update(old, new, overwrite=True):
+    if not overwrite:
+        res = legacy_deep_copy(old)
+    else:
+        res = old
+    for k,v in new.items():
+        if isinstance(v, dict) and k in res and isinstance(res[k], dict):
+            legacy_deep_update(res[k], v)
+        else:
+            res[k] = v
+    return res
+
+def make_tree(depth, width, leaf=0):
+    """Tree with `width` leaves and `width` sub-dictionaries on every level."""
+    res = {'leaf_{}'.format(i): leaf for i in range(width)}
+    if depth > 0:
+        for i in range(width):
+            res['node_{}'.format(i)] = make_tree(depth-1, width, leaf)
+    return res
+
+def make_path_update(depth, value=1):
+    """Update touching a single leaf at the bottom of the tree."""
+    res = {'leaf_0': value}
+    for _ in range(depth):
+        res = {'node_0': res}
+    return res
+
+def bench(name, func, number):
+    t = min(timeit.repeat(func, number=number, repeat=3)) / number
+    print('  {:<40s} {:10.2f} us'.format(name, t * 1E6))
+    return t
+
+def main():
+    cases = {
+        'deep (depth=12, width=2)': (12, 2),
+        'wide (depth=2, width=60)': (2, 60),
+        'QE-like (depth=3, width=12)': (3, 12),
+        }
+    for label, (depth, width) in cases.items():
+        tree = make_tree(depth, width)
+        full = make_tree(depth, width, leaf=1)
+        path = make_path_update(depth)
+        number = 20
+
+        assert deep_copy(tree) == legacy_deep_copy(tree)
+        assert deep_update(tree, full, overwrite=False) == legacy_deep_update(tree, full, overwrite=False)
+        assert deep_update(tree, path, overwrite=False) == legacy_deep_update(tree, path, overwrite=False)
+
+        print(label)
+        bench('legacy deep_copy', lambda: legacy_deep_copy(tree), number)
+        bench('deep_copy', lambda: deep_copy(tree), number)
+        bench('legacy deep_update(overwrite=False) leaf', lambda: legacy_deep_update(tree, path, False), number)
+        bench('deep_update(overwrite=False) leaf', lambda: deep_update(tree, path, False), number)
+        bench('legacy deep_update(overwrite=False) full', lambda: legacy_deep_update(tree, full, False), number)
+        bench('deep_update(overwrite=False) full', lambda: deep_update(tree, full, False), number)
+        bench('legacy deep_update(overwrite=True) full', lambda: legacy_deep_update(legacy_deep_copy(tree), full), number)
+        bench('deep_update(overwrite=True) full', lambda: deep_update(legacy_deep_copy(tree), full), number)
+
+if __name__ == '__main__':
+    main()
@@ -1,5 +1,6 @@
-from .inputs import ListInputs_to_dict
-from .reports import analyze_workchain
+from .inputs import ListInputs_to_dict, nest_link_labels
+from .reports import analyze_workchain, scan_workchains
 from .supercell import make_supercell
-from .band_structure import plot_bandstructure
-from .analyze_FindCrossingsWorkChain import analyze_FindCrossingsWorkChain
\ No newline at end of file
+from .band_structure import plot_bandstructure, plot_bandstructures, load_band_data
+from .analyze_FindCrossingsWorkChain import analyze_FindCrossingsWorkChain, analyze_FindCrossingsWorkChains
+from .utils import probe_remote_folders, report_new
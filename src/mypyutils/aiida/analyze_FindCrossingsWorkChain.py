@@ -1,35 +1,207 @@
+import os
+import hashlib
+import logging
+
 import numpy as np
-from scipy.spatial import KDTree
 
-from .utils import validate_node
+from aiida import orm
 
-def recipr_base(base):
-    return np.linalg.inv(base).T * 2 * np.pi
+from ..kspace import recipr_base, PeriodicKTree
+from .utils import validate_node, get_pks, get_process_pool, atomic_open
 
-def void(*args, **kwargs):
-    return
+CROSSINGS_DTYPE = np.dtype([
+    ('pk', np.int64),
+    ('iteration', np.int32),
+    ('bands', np.int64),
+    ('kpt', np.float64, (3,)),
+    ('gap', np.float64),
+    ('status', 'U6'),
+    ('distance', np.float64),
+    ])
 
-def analyze_FindCrossingsWorkChain(node, gap_thr=0.0025, noprint=False):
-    wc = validate_node(node)
-    if noprint:
-        log = void
+logger = logging.getLogger(__name__)
+
+VERBOSITY_LEVELS = {0: logging.WARNING, 1: logging.INFO, 2: logging.DEBUG}
+
+class _CallLogger(logging.LoggerAdapter):
+    """Logger adapter filtering the messages of a single call with its own `level`.
+
+    If `fallback` is True (output requested but logging not configured by the application), the enabled
+    messages are printed to stdout instead of being passed to the (handler-less) logger.
+    """
+    def __init__(self, logger, level, fallback=False):
+        super().__init__(logger, {})
+        self.level    = level
+        self.fallback = fallback
+
+    def isEnabledFor(self, level):
+        if level < self.level:
+            return False
+        return self.fallback or self.logger.isEnabledFor(level)
+
+    def log(self, level, msg, *args, **kwargs):
+        if not self.isEnabledFor(level):
+            return
+        if self.fallback:
+            print(msg % args if args else msg)
+        else:
+            self.logger.log(level, msg, *args, **kwargs)
+
+# Increase when the per-iteration analysis changes, to invalidate the on-disk cache
+_ALGORITHM_VERSION = 1
+
+def _cache_fname(cache_dir, uuid, gap_thr, cb):
+    key = hashlib.sha1(repr((float(gap_thr), int(cb), _ALGORITHM_VERSION)).encode()).hexdigest()[:16]
+    return os.path.join(cache_dir, '{}_{}.npz'.format(uuid, key))
+
+def _load_cache(fname):
+    with np.load(fname) as f:
+        return {k:(f[k].item() if f[k].ndim == 0 else f[k]) for k in f.files}
+
+def _save_cache(fname, data):
+    with atomic_open(fname, 'wb') as f:
+        np.savez(f, **data)
+
+def _select_candidates(gq, min_gap, scale, lim, factor=0.98, scale_min=1.0001):
+    """Select the indexes of the smallest gaps in `gq` under a shrinking threshold.
+
+    Equivalent to repeatedly taking `np.where(gq < min_gap * scale)` while shrinking `scale` by `factor`
+    until at most `lim` gaps are selected, falling back to `min_gap * scale_min` once the scale would
+    go below `scale_min`. The first acceptable threshold is found in closed form from the `lim`-th
+    smallest gap instead of recounting the candidates at every step.
+    """
+    if np.isfinite(scale) and scale > 0:
+        n_steps = max(int(np.ceil(np.log(scale_min / scale) / np.log(factor))), 0) + 2
+        scales  = np.cumprod(np.concatenate(([scale], np.full(n_steps, factor))))
     else:
-        log = print
-    log('Analyzing {}<{}>'.format(wc.process_class.__name__, wc.pk))
+        scales  = np.array([scale, scale*factor])
+    # Thresholds that are tried before falling back to `scale_min`
+    valid  = np.cumprod(scales[1:] >= scale_min).astype(bool)
+    thresh = min_gap * scales[:-1][valid]
+
+    res = min_gap * scale_min
+    if len(gq) <= lim:
+        if len(thresh):
+            res = thresh[0]
+    else:
+        kth = np.partition(gq, int(lim))[int(lim)]
+        ok  = np.where(~(kth < thresh))[0]
+        if len(ok):
+            res = thresh[ok[0]]
+
+    return np.where(gq < res)[0]
+
+def prefetch_FindCrossingsWorkChain(node):
+    """Load all the data needed to analyze a FindCrossingsWorkChain with a few QueryBuilder queries.
+
+    Return:
+     Dictionary with:
+      - parameters: number of electrons and spin-orbit flag from the `output_parameters` of the first calculation.
+      - iterations: list (sorted by decreasing BandsData pk) of dictionaries with the `bands` BandsData, the
+                    pk of its creator `calc`, the `centers` ArrayData and `distance` used to generate its kpoints
+                    (None if not available).
+    """
+    wc = validate_node(node)
+
+    # BandsData given as input to the called processes
+    qb = orm.QueryBuilder()
+    qb.append(orm.WorkflowNode, filters={'id': wc.pk}, tag='wc')
+    qb.append(
+        orm.ProcessNode, with_incoming='wc', tag='called',
+        edge_filters={'type': {'in': ['call_calc', 'call_work']}},
+        )
+    qb.append(
+        orm.BandsData, with_outgoing='called', tag='bands', project='*',
+        edge_filters={'label': 'bands_data'},
+        )
+    bands = {b.pk:b for b, in qb.iterall()}
+    if not bands:
+        raise ValueError('No `bands_data` found in the processes called by {}<{}>'.format(wc.process_label, wc.pk))
+
+    # Creator calculations and their output parameters
+    qb = orm.QueryBuilder()
+    qb.append(orm.BandsData, filters={'id': {'in': list(bands)}}, tag='bands', project='id')
+    qb.append(
+        orm.CalcJobNode, with_outgoing='bands', tag='calc', project='id',
+        edge_filters={'type': 'create'},
+        )
+    qb.append(
+        orm.Dict, with_incoming='calc',
+        edge_filters={'label': 'output_parameters'},
+        project=['attributes.number_of_electrons', 'attributes.spin_orbit_calculation'],
+        )
+    calcs  = {}
+    params = {}
+    for bands_pk, calc_pk, n_el, spin in qb.iterall():
+        calcs[bands_pk]  = calc_pk
+        params[calc_pk]  = {'number_of_electrons': n_el, 'spin_orbit_calculation': spin}
+
+    # Inputs of the calcfunction that generated the kpoints of every calculation
+    def get_kpt_inputs(label, cls, project):
+        qb = orm.QueryBuilder()
+        qb.append(orm.CalcJobNode, filters={'id': {'in': list(calcs.values())}}, tag='calc', project='id')
+        qb.append(orm.KpointsData, with_outgoing='calc', tag='kpt', edge_filters={'label': 'kpoints'})
+        qb.append(orm.CalculationNode, with_outgoing='kpt', tag='kcreator', edge_filters={'type': 'create'})
+        qb.append(cls, with_outgoing='kcreator', edge_filters={'label': label}, project=project)
+        return dict(qb.all())
+
+    if not params:
+        raise ValueError('No creator calculation with `output_parameters` found for the `bands_data` of {}<{}>'.format(
+            wc.process_label, wc.pk))
+
+    centers  = get_kpt_inputs('centers', orm.ArrayData, '*') if calcs else {}
+    distance = get_kpt_inputs('distance', orm.Float, 'attributes.value') if calcs else {}
+
+    iterations = []
+    for pk in sorted(bands, reverse=True):
+        calc_pk = calcs.get(pk, None)
+        iterations.append({
+            'bands': bands[pk],
+            'calc': calc_pk,
+            'centers': centers.get(calc_pk, None),
+            'distance': distance.get(calc_pk, None),
+            })
 
-    l_find = [called for called in wc.called if 'bands_data' in list(called.inputs)]
+    return {
+        'parameters': params[min(params)] if params else None,
+        'iterations': iterations,
+        }
+
+def analyze_FindCrossingsWorkChain(node, gap_thr=0.0025, noprint=False, verbosity=None, cache_dir=None):
+    """Analyze the iterations of a FindCrossingsWorkChain.
+
+    Params:
+     - node: FindCrossingsWorkChain node or pk.
+     - gap_thr: gap under which a k-point is considered a crossing.
+     - noprint: If True, equivalent to `verbosity=0`.
+     - verbosity: 0 = warnings only, 1 = summary of every iteration, 2 = full trace (default unless `noprint`).
+                  Messages are emitted through the `logging` module, so that nothing is formatted at low verbosity.
+                  If the application did not configure any logging handler, they are printed to stdout.
+     - cache_dir: If specified, the result of every iteration is cached in this directory, keyed by the
+                  BandsData UUID, `gap_thr` and algorithm version, so that only new iterations are analyzed
+                  when the function is called again.
+    """
+    if verbosity is None:
+        verbosity = 0 if noprint else 2
+    level = VERBOSITY_LEVELS[min(max(verbosity, 0), 2)]
+
+    log = _CallLogger(logger, level, fallback=verbosity > 0 and not logger.hasHandlers())
 
-    calc   = l_find[0].inputs.bands_data.creator
-    param  = calc.outputs.output_parameters.get_dict()
+    return _analyze_FindCrossingsWorkChain(validate_node(node), gap_thr, cache_dir, log)
+
+def _analyze_FindCrossingsWorkChain(wc, gap_thr, cache_dir=None, log=logger):
+    debug = log.isEnabledFor(logging.DEBUG)
+    log.info('Analyzing %s<%d>', wc.process_label, wc.pk)
+
+    data   = prefetch_FindCrossingsWorkChain(wc)
+    param  = data['parameters']
     n_el   = param['number_of_electrons']
     spin   = param['spin_orbit_calculation']
     cb     = round(n_el) // (int(not spin) + 1)
     vb     = cb - 1
 
-    lbands  = [c.inputs.bands_data for c in l_find]
-    lbands.sort(key=lambda x: x.pk, reverse=True)    
-
     res = {
+        'bands':[],
         'min_gap':[],
         'pinned':[],
         'pgaps':[],
@@ -37,42 +209,50 @@ def analyze_FindCrossingsWorkChain(node, gap_thr=0.0025, noprint=False):
         'fgaps':[],
         'distance':[]
         }
-    for nn, bands in enumerate(lbands):
+    for nn, it in enumerate(data['iterations']):
+        bands = it['bands']
+        cache_fname = None
+        if cache_dir is not None:
+            cache_fname = _cache_fname(cache_dir, bands.uuid, gap_thr, cb)
+            if os.path.exists(cache_fname):
+                log.info('bands<%d> loaded from cache', bands.pk)
+                for k,v in _load_cache(cache_fname).items():
+                    res[k].append(v)
+                continue
+
         b = bands.get_bands()
         kpt_c = bands.get_kpoints(cartesian=True)
         g = b[:,cb] - b[:,vb]
 
         cell   = bands.cell
         recipr = recipr_base(cell)
-        irecipr = np.linalg.inv(recipr)
 
 
-        log('bands<{}>'.format(bands.pk))
-        try:
-            kki      = bands.creator.inputs.kpoints.creator.inputs
-            pinned   = kki.centers.get_array('pinned')
-            distance = kki.distance.value
-        except:
+        log.info('bands<%d>', bands.pk)
+        centers = it['centers']
+        if centers is not None and 'pinned' in centers.get_arraynames() and it['distance'] is not None:
+            pinned   = centers.get_array('pinned')
+            distance = it['distance']
+        else:
             distance = 200
             pinned = np.array([[0.,0.,0.]])
-        log('  prev distance: {}, gap_thr: {}'.format(distance, gap_thr))
+        log.info('  prev distance: %s, gap_thr: %s', distance, gap_thr)
         
-        centers  = KDTree(pinned)
-        kpt_tree = KDTree(kpt_c)
-        query    = centers.query_ball_tree(kpt_tree, r=distance*1.74/2)
+        kpt_tree = PeriodicKTree(kpt_c, recipr)
+        query    = kpt_tree.query_ball_point(pinned, r=distance*1.74/2)
 
         pinned_thr = distance * 4.00
 
         lim = max(-5 // np.log10(distance), 1) if distance < 1 else 200
         if distance < 0.01:
             lim = 1
-        log('    LIM: {}'.format(lim))
+        log.debug('    LIM: %s', lim)
         where_found  = []
         where_pinned = []
         for n,q in enumerate(query):
-            q = np.array(q, dtype=np.int)
+            q = np.array(q, dtype=int)
             if len(q) == 0:
-                log('    skipping {}, no neighbours'.format(pinned[n]))
+                log.debug('    skipping %s, no neighbours', pinned[n])
                 continue
 
             mi =  g[q].argmin()
@@ -85,48 +265,104 @@ def analyze_FindCrossingsWorkChain(node, gap_thr=0.0025, noprint=False):
             # if min_gap / prev_min_gap > 0.95 and distance < 0.005:
             #     log('         skipping mg/pmg: {}'.format(min_gap / prev_min_gap))
             #     continue
-            log('    {:2d}.  min_gap: {:.6f}  kpt: {}  pinned: {}'.format(n, min_gap, kpt_c[q][mi], pinned[n]))
+            if debug:
+                log.debug('    %2d.  min_gap: %.6f  kpt: %s  pinned: %s', n, min_gap, kpt_c[q[mi]], pinned[n])
             scale = 2.5 if lim > 1 else 1.0001
             if distance == 200:
                 scale = 0.25 / min_gap
-            app = None
-            while app is None or len(app) > lim:
-                app = np.where(g[q] < min_gap * scale)[0]
-                scale *= 0.98
-                if scale < 1.0001:
-                    app = np.where(g[q] < min_gap * 1.0001)[0]
-                    break
-            where_found.extend([q[i] for i in app if g[q[i]] <= gap_thr])
-            aaa = [q[i] for i in app if gap_thr < g[q[i]]]
-            where_pinned.extend([q[i] for i in app if gap_thr < g[q[i]] < pinned_thr])
-
-            where_app = [q[i] for i in app if g[q[i]] >= pinned_thr]
-            if where_app:
-                log('         Skipping {} out of {} for fermi velocity'.format(where_app, aaa))
-
-        wp = np.unique(np.array(where_pinned, dtype=np.int))
-        wf = np.unique(np.array(where_found, dtype=np.int))
-
-        log('    --------------')
-
-        for n, w in enumerate(wp):
-            min_gap = g[w]
-            min_kpt = kpt_c[w]
-            log('   {:4d}.   GAP: {:.6f}  kpt_cart: {},  kpt_cryst: {}'.format(n, min_gap, min_kpt, np.dot(min_kpt, irecipr)))
-
-        log("    Min gap: {},  kpt: {}".format(g.min(), kpt_c[g.argmin()]))
-
-        log('NEW pinned count: {}'.format(len(wp)))
-        log('FOUND:', len(wf))
+            app = _select_candidates(g[q], min_gap, scale, lim)
+
+            qa = q[app]
+            ga = g[qa]
+            where_found.append(qa[ga <= gap_thr])
+            where_pinned.append(qa[(gap_thr < ga) & (ga < pinned_thr)])
+
+            skip = ga >= pinned_thr
+            if debug and skip.any():
+                log.debug('         Skipping %s out of %s for fermi velocity', qa[skip].tolist(), qa[gap_thr < ga].tolist())
+
+        wp = np.unique(np.concatenate(where_pinned + [np.array([], dtype=int)]))
+        wf = np.unique(np.concatenate(where_found + [np.array([], dtype=int)]))
+
+        if debug:
+            log.debug('    --------------')
+            irecipr = np.linalg.inv(recipr)
+            for n, w in enumerate(wp):
+                min_kpt = kpt_c[w]
+                log.debug('   %4d.   GAP: %.6f  kpt_cart: %s,  kpt_cryst: %s', n, g[w], min_kpt, np.dot(min_kpt, irecipr))
+
+        log.info('    Min gap: %s,  kpt: %s', g.min(), kpt_c[g.argmin()])
+
+        log.info('NEW pinned count: %d', len(wp))
+        log.info('FOUND: %d', len(wf))
         for f in wf:
-            log('  kpt: {}   gap: {:.6f}'.format(kpt_c[f], g[f]))
-        log()
+            log.info('  kpt: %s   gap: %.6f', kpt_c[f], g[f])
+        log.info('')
+
+        new = {
+            'bands': bands.pk,
+            'min_gap': g.min(),
+            'pinned': kpt_c[wp],
+            'pgaps': g[wp],
+            'found': kpt_c[wf],
+            'fgaps': g[wf],
+            'distance': distance,
+            }
+        for k,v in new.items():
+            res[k].append(v)
+        if cache_fname is not None:
+            _save_cache(cache_fname, new)
+
+    return res
+
+def crossings_to_array(pk, res):
+    """Convert the output of `analyze_FindCrossingsWorkChain` to a structured array with dtype `CROSSINGS_DTYPE`.
+
+    Every row is a found or pinned k-point. Iterations are numbered from 0 (oldest BandsData).
+    """
+    n_it = len(res['bands'])
+    rows = []
+    for nn in range(n_it):
+        it = n_it - 1 - nn
+        for status, kpts, gaps in [('found', res['found'][nn], res['fgaps'][nn]), ('pinned', res['pinned'][nn], res['pgaps'][nn])]:
+            for kpt, gap in zip(kpts, gaps):
+                rows.append((pk, it, res['bands'][nn], kpt, gap, status, res['distance'][nn]))
+
+    return np.array(rows, dtype=CROSSINGS_DTYPE)
+
+def _analyze_worker(pk, gap_thr, cache_dir=None):
+    try:
+        res = analyze_FindCrossingsWorkChain(pk, gap_thr=gap_thr, noprint=True, cache_dir=cache_dir)
+    except Exception as e:
+        return pk, None, '{}: {}'.format(type(e).__name__, e)
+    return pk, crossings_to_array(pk, res), None
+
+def analyze_FindCrossingsWorkChains(nodes, gap_thr=0.0025, processes=None, cache_dir=None):
+    """Analyze many FindCrossingsWorkChain in parallel.
+
+    Params:
+     - nodes: Group, QueryBuilder or list of nodes/pks of the workchains.
+     - gap_thr, cache_dir: passed to `analyze_FindCrossingsWorkChain`.
+     - processes: number of worker processes (None = number of CPUs). If 0, run in the current process.
+    Return:
+     Structured array with dtype `CROSSINGS_DTYPE` (fields pk, iteration, bands, kpt, gap, status, distance)
+     with one row per found/pinned k-point of every workchain, and a dictionary {pk: error message} of the
+     workchains that could not be analyzed.
+    """
+    pks = get_pks(nodes)
+
+    if processes == 0:
+        results = [_analyze_worker(pk, gap_thr, cache_dir) for pk in pks]
+    else:
+        with get_process_pool(processes) as pool:
+            results = list(pool.map(_analyze_worker, pks, [gap_thr]*len(pks), [cache_dir]*len(pks)))
 
-        res['min_gap'].append(g.min())
-        res['pinned'].append(kpt_c[wp])
-        res['pgaps'].append(g[wp])
-        res['found'].append(kpt_c[wf])
-        res['fgaps'].append(g[wf])
-        res['distance'].append(distance)
+    arrays = [np.empty(0, dtype=CROSSINGS_DTYPE)]
+    failed = {}
+    for pk, arr, err in results:
+        if err is None:
+            arrays.append(arr)
+        else:
+            failed[pk] = err
 
-    return res
\ No newline at end of file
+    return np.concatenate(arrays), failed
@@ -1,9 +1,100 @@
 import os
+import glob
+import json
+import time
+import hashlib
 import numpy as np
+import matplotlib
 import matplotlib.pyplot as plt
 
+from concurrent.futures import as_completed
+
 from aiida import orm
 
+from .utils import get_pks, get_process_pool, atomic_open
+
+MANIFEST_NAME = '.plot_manifest.json'
+
+def _plot_params_hash(dy=None, ext='pdf', formula='', save_dat=False, plot_kwargs={}):
+    params = {
+        'dy': dy, 'ext': ext, 'formula': formula, 'save_dat': save_dat, 'plot_kwargs': plot_kwargs
+        }
+    return hashlib.sha1(json.dumps(params, sort_keys=True, default=str).encode()).hexdigest()
+
+class PlotManifest():
+    """Record of the plots already rendered inside `savedir`.
+
+    The entries are keyed by node UUID and store the hash of the plotting parameters and the output file,
+    with a secondary index by pk, so that completed plots can be skipped without any database access.
+    Entries whose parameters differ from the requested ones are considered stale.
+    """
+    def __init__(self, savedir='.', load=True):
+        self.fname = os.path.join(savedir, MANIFEST_NAME)
+        self.entries = {}
+        if load and os.path.exists(self.fname):
+            with open(self.fname) as f:
+                self.entries = json.load(f)
+        self.by_pk = {e['pk']:uuid for uuid, e in self.entries.items()}
+
+    def add(self, uuid, pk, params_hash, fname):
+        self.entries[uuid] = {'pk': pk, 'params': params_hash, 'file': fname}
+        self.by_pk[pk] = uuid
+
+    def update(self, entries):
+        self.entries.update(entries)
+        self.by_pk.update((e['pk'], uuid) for uuid, e in entries.items())
+
+    def is_done(self, uuid, params_hash):
+        """Return True/False if the node has a valid/stale entry, None if it is not in the manifest."""
+        entry = self.entries.get(uuid, None)
+        if entry is None:
+            return None
+        return entry['params'] == params_hash and os.path.exists(entry['file'])
+
+    def is_done_pk(self, pk, params_hash):
+        uuid = self.by_pk.get(pk, None)
+        if uuid is None:
+            return None
+        return self.is_done(uuid, params_hash)
+
+    def save(self):
+        with atomic_open(self.fname) as f:
+            json.dump(self.entries, f, indent=1)
+
+def save_band_data(base, x, y, labels=(), fermi=0., **metadata):
+    """Save band data in binary format as `<base>.x.npy`, `<base>.y.npy` and `<base>.json`.
+
+    The `.npy` files can be opened memory-mapped with `load_band_data`, the `.json` file contains the
+    high-symmetry labels, the Fermi energy and any additional `metadata`.
+    """
+    np.save(base + '.x.npy', np.ascontiguousarray(x))
+    np.save(base + '.y.npy', np.ascontiguousarray(y))
+
+    metadata.update({
+        'labels': [[float(pos), str(lab)] for pos, lab in labels],
+        'fermi': float(fermi),
+        'shape': list(np.shape(y)),
+        })
+    with open(base + '.json', 'w') as f:
+        json.dump(metadata, f, indent=1)
+
+def load_band_data(base, mmap_mode='r'):
+    """Load band data saved with `save_band_data`.
+
+    Params:
+     - base: path of the files without the `.x.npy`/`.y.npy`/`.json` suffixes.
+     - mmap_mode: passed to `np.load`. Default 'r' returns read-only memory-mapped arrays.
+    Return:
+     x, y arrays and the metadata dictionary (with `labels` as a list of (position, label) tuples).
+    """
+    x = np.load(base + '.x.npy', mmap_mode=mmap_mode)
+    y = np.load(base + '.y.npy', mmap_mode=mmap_mode)
+    with open(base + '.json') as f:
+        metadata = json.load(f)
+    metadata['labels'] = [tuple(_) for _ in metadata['labels']]
+
+    return x, y, metadata
+
 def plot_bandstructure(
     node, 
     ax=None,
@@ -11,8 +102,27 @@ def plot_bandstructure(
     skip_done=False,
     save=True, savedir='.', ext='pdf', formula='', save_dat=False,
     plot_kwargs={},
+    manifest=None,
     # line_kwargs={}
     ):
+    """Plot the band structure of a BandsData, PwBandsWorkChain or Wannier90BandsWorkChain.
+
+    If `skip_done` is True and the node is recorded in the manifest of `savedir` with the same plotting
+    parameters, return None before loading any data. Nodes not in the manifest are skipped if the output
+    file already exists.
+    `manifest` can be None (use and update the manifest of `savedir` only if `skip_done` is True), a
+    `PlotManifest` instance (updated but not saved) or False (never use a manifest).
+    `save_dat` can be True/'txt' to save the bands in a `.dat` text file or 'npy' to save them in binary format
+    (see `save_band_data`/`load_band_data`).
+    """
+    params_hash = _plot_params_hash(dy, ext, formula, save_dat, plot_kwargs)
+    save_manifest = manifest is None and skip_done
+    if save_manifest:
+        manifest = PlotManifest(savedir)
+
+    if skip_done and manifest and manifest.is_done(node.uuid, params_hash):
+        return None
+
     struct = None
     param = None
     if isinstance(node, orm.BandsData):
@@ -43,19 +153,24 @@ def plot_bandstructure(
     os.makedirs(savedir, exist_ok=True)
     fname = os.path.join(savedir, '{}-{}.{}'.format(node.pk, formula, ext))
 
+    if skip_done and os.path.exists(fname) and (not manifest or manifest.is_done(node.uuid, params_hash) is None):
+        return None
+
     plot_info = data._get_bandplot_data(cartesian=True, prettify_format='gnuplot_seekpath', join_symbol='|', y_origin=ef)
 
     x = np.array(plot_info['x'])
     y = np.array(plot_info['y'])
 
-    if save_dat:
+    if save_dat == 'npy':
+        save_band_data(
+            os.path.splitext(fname)[0], x, y, plot_info['labels'], ef,
+            pk=node.pk, uuid=node.uuid, bands_pk=data.pk, bands_uuid=data.uuid
+            )
+    elif save_dat:
         res = np.hstack((x.reshape(-1,1), y))
         dat_fname = fname.replace(f'.{ext}', '.dat')
         np.savetxt(dat_fname, res, header=f'Fermi = {ef}')
 
-    if skip_done and os.path.exists(fname):
-        return x,y
-
     if dy:
         ymin = -dy
         ymax = dy
@@ -78,6 +193,7 @@ def plot_bandstructure(
         fig, ax = plt.subplots()
         newax = True
 
+    plot_kwargs = dict(plot_kwargs)
     plot_kwargs.setdefault('color', 'k')
     plot_kwargs.setdefault('linewidth', .5)
 
@@ -97,8 +213,121 @@ def plot_bandstructure(
     
     # pdf.savefig(fig)
     if save:
-        plt.savefig(fname)
+        ax.figure.savefig(fname)
+        if manifest:
+            manifest.add(node.uuid, node.pk, params_hash, fname)
+            if save_manifest:
+                manifest.save()
     if newax:
         plt.close(fig)
     
     return x, y, line
+
+
+def _is_done(pk, savedir, ext, manifest, params_hash):
+    done = manifest.is_done_pk(pk, params_hash)
+    if done is None:
+        return bool(glob.glob(os.path.join(glob.escape(savedir), '{}-*.{}'.format(pk, ext))))
+    return done
+
+def _init_plot_worker():
+    matplotlib.use('Agg')
+
+def _plot_chunk(pks, kwargs):
+    """Plot a chunk of nodes on a single reused Agg figure.
+
+    Return:
+     List of (pk, error) tuples, where error is None for successful plots, and the new manifest entries.
+    """
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+
+    fig = Figure()
+    FigureCanvasAgg(fig)
+    ax = fig.add_subplot(111)
+
+    qb = orm.QueryBuilder()
+    qb.append(orm.Node, filters={'id': {'in': list(pks)}}, project='*')
+    nodes = {n.pk:n for n, in qb.iterall()}
+
+    plot_kwargs = kwargs.pop('plot_kwargs', {})
+    manifest = PlotManifest(kwargs['savedir'], load=False)
+
+    res = []
+    for pk in pks:
+        ax.clear()
+        try:
+            plot_bandstructure(nodes[pk], ax=ax, plot_kwargs=dict(plot_kwargs), manifest=manifest, **kwargs)
+        except Exception as e:
+            res.append((pk, '{}: {}'.format(type(e).__name__, e)))
+        else:
+            res.append((pk, None))
+
+    return res, manifest.entries
+
+def plot_bandstructures(
+    nodes,
+    processes=None,
+    chunksize=16,
+    skip_done=False,
+    savedir='.', ext='pdf',
+    **kwargs
+    ):
+    """Plot the band structure of many nodes in parallel.
+
+    Every worker process renders its chunk of nodes with the non-interactive Agg backend on a single
+    reused figure, loading all the nodes of the chunk with one query.
+
+    Params:
+     - nodes: Group, QueryBuilder or list of nodes/pks of the nodes to plot.
+     - processes: number of worker processes (None = number of CPUs). If 0, plot in the current process.
+     - chunksize: number of nodes sent to a worker at once.
+     - skip_done: If True, skip the nodes already rendered with the same parameters according to the manifest
+                  of `savedir` (or, for nodes not in the manifest, with a `{pk}-*.{ext}` file present).
+                  The check is done on the pks before any database access.
+     - savedir, ext, **kwargs: passed to `plot_bandstructure` (`save` is always True).
+    Return:
+     Dictionary {pk: error message} of the nodes that failed.
+    """
+    pks = get_pks(nodes)
+
+    manifest = PlotManifest(savedir)
+    params_hash = _plot_params_hash(
+        kwargs.get('dy', None), ext, kwargs.get('formula', ''), kwargs.get('save_dat', False), kwargs.get('plot_kwargs', {})
+        )
+
+    n_tot = len(pks)
+    if skip_done:
+        pks = [pk for pk in pks if not _is_done(pk, savedir, ext, manifest, params_hash)]
+    n_skip = n_tot - len(pks)
+
+    kwargs.update(save=True, savedir=savedir, ext=ext)
+    kwargs.pop('ax', None)
+    kwargs.pop('manifest', None)
+    chunks = [pks[i:i+chunksize] for i in range(0, len(pks), chunksize)]
+
+    start  = time.time()
+    failed = {}
+    def collect(res, entries):
+        failed.update((pk, err) for pk, err in res if err is not None)
+        manifest.update(entries)
+        manifest.save()
+
+    if processes == 0:
+        for chunk in chunks:
+            collect(*_plot_chunk(chunk, dict(kwargs)))
+    else:
+        with get_process_pool(processes, initializer=_init_plot_worker) as pool:
+            futures = [pool.submit(_plot_chunk, chunk, dict(kwargs)) for chunk in chunks]
+            for fut in as_completed(futures):
+                collect(*fut.result())
+    elapsed = time.time() - start
+
+    n_done = len(pks) - len(failed)
+    print('Plotted {} nodes in {:.1f} s ({:.2f} nodes/s), skipped {}, failed {}'.format(
+        n_done, elapsed, n_done / elapsed if elapsed else 0, n_skip, len(failed)
+        ))
+    for pk, err in failed.items():
+        print('  - {}: {}'.format(pk, err))
+
+    return failed
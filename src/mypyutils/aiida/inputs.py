@@ -1,27 +1,69 @@
-from ..dict import deep_update
-
-def ListInputs_to_dict(inputs):
-    app = {}
-    for name in list(inputs):
-        value = getattr(inputs, name)
-        app[name] = value
-
-    new = {}
-    for k, v in app.items():
-        if not '__' in k:
-            new[k] = v
-            continue
-        nested = k.split('__')
-        res = {}
+class LazyNode():
+    """Proxy to the node linked with `label` in a links manager (e.g. `node.outputs`).
+
+    The node is loaded on the first attribute access (or explicitly with `load`).
+    """
+    __slots__ = ('_manager', '_label', '_node')
+
+    def __init__(self, manager, label):
+        self._manager = manager
+        self._label   = label
+        self._node    = None
+
+    def load(self):
+        if self._node is None:
+            self._node = getattr(self._manager, self._label)
+        return self._node
+
+    def __getattr__(self, name):
+        return getattr(self.load(), name)
+
+    def __repr__(self):
+        state = 'loaded' if self._node is not None else 'not loaded'
+        return '<LazyNode: {} ({})>'.format(self._label, state)
+
+def _iter_links(inputs):
+    """Iterate over the (label, node) pairs of a links manager, loading all the nodes with a single query if possible."""
+    node      = getattr(inputs, '_node', None)
+    link_type = getattr(inputs, '_link_type', None)
+    incoming  = getattr(inputs, '_incoming', None)
+    if node is None or link_type is None or incoming is None:
+        for name in list(inputs):
+            yield name, getattr(inputs, name)
+        return
+
+    if incoming:
+        links = node.get_incoming(link_type=link_type)
+    else:
+        links = node.get_outgoing(link_type=link_type)
+    for link in links.all():
+        yield link.link_label, link.node
+
+def nest_link_labels(items, sep='__'):
+    """Build a nested dictionary from (key, value) pairs, splitting the keys on `sep`."""
+    res = {}
+    for k, v in items:
+        *path, last = k.split(sep)
         ptr = res
-        num = len(nested)
-        for i, name in enumerate(nested):
-            if i < num -1:
-                ptr[name] = {}
-                ptr = ptr[name]
-            else:
-                ptr[name] = v
+        for name in path:
+            nxt = ptr.get(name, None)
+            if not isinstance(nxt, dict):
+                nxt = ptr[name] = {}
+            ptr = nxt
+        ptr[last] = v
+
+    return res
+
+def ListInputs_to_dict(inputs, lazy=False):
+    """Convert a links manager (e.g. `node.inputs`/`node.outputs`) to a nested dictionary of nodes.
 
-        deep_update(new, res)
+    Params:
+     - inputs: links manager whose `a__b__c` link labels are converted to nested namespaces.
+     - lazy: If True, return `LazyNode` proxies that load the node only when accessed.
+    """
+    if lazy:
+        items = ((name, LazyNode(inputs, name)) for name in list(inputs))
+    else:
+        items = _iter_links(inputs)
 
-    return new
\ No newline at end of file
+    return nest_link_labels(items)
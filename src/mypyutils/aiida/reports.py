@@ -1,4 +1,7 @@
-from .utils import report_failed, report_exception, report_running, validate_node
+from aiida import orm
+from aiida.orm.utils import load_node
+
+from .utils import report_failed, report_exception, report_running, validate_node, get_pks, query_processes, query_called
 
 def analyze_workchain(
     node,
@@ -43,4 +46,115 @@ def analyze_workchain(
 
     print(tab + 'still running')
     if not on_running is None:
-        return on_running(wc)
\ No newline at end of file
+        return on_running(wc)
+
+def find_failing_descendants(pks):
+    """Find the deepest failed/excepted descendant of every process in `pks`, one query per call level.
+
+    At every level the latest (highest pk) failed or excepted called process is followed.
+    Return:
+     Dictionary {pk: info of the failing descendant (or None)}.
+    """
+    res  = {pk:None for pk in pks}
+    ptrs = {pk:pk for pk in pks}
+    while ptrs:
+        called = query_called(list(set(ptrs.values())))
+        new = {}
+        for root, ptr in ptrs.items():
+            failed = [c for c in called.get(ptr, []) if c['state'] in ('failed', 'excepted')]
+            if not failed:
+                continue
+            child = max(failed, key=lambda c: c['pk'])
+            res[root] = child
+            new[root] = child['pk']
+        ptrs = new
+
+    return res
+
+def scan_workchains(
+    nodes,
+    report_actions={},
+    on_killed=None,
+    on_running=None,
+    on_finished_ok=None,
+    on_failed=None,
+    on_excepted=None,
+    summary=True,
+    ):
+    """Bulk version of `analyze_workchain`.
+
+    Process state, exit status and message of all the nodes, and the failing descendant of the failed ones,
+    are fetched with a few QueryBuilder queries (one per call level for the descendants).
+    The nodes are loaded only to be passed to the `on_*` callbacks and to the `report_actions`.
+    As in `analyze_workchain`, the `report_actions` (keyed by process class) are called on the failing
+    descendant of the failed processes only.
+    Unlike `analyze_workchain`, `on_running` defaults to None, as `report_running` accesses the remote folder.
+
+    Params:
+     - nodes: Group, QueryBuilder or list of nodes/pks.
+     - summary: If True, print a summary table.
+    Return:
+     Dictionary {pk: info} with the projected attributes, the `state` (killed, finished_ok, failed, excepted,
+     running), the `failing` descendant info, the `action_result` of the report action and the `result`
+     of the `on_*` callback.
+    """
+    pks   = get_pks(nodes, orm.ProcessNode)
+    infos = query_processes(pks)
+
+    failed  = [pk for pk, info in infos.items() if info['state'] in ('failed', 'excepted')]
+    failing = find_failing_descendants(failed) if failed else {}
+
+    callbacks = {
+        'killed': on_killed,
+        'running': on_running,
+        'finished_ok': on_finished_ok,
+        'failed': on_failed,
+        'excepted': on_excepted,
+        }
+    actions = {typ.__name__:act for typ, act in report_actions.items()}
+    for pk, info in infos.items():
+        desc = failing.get(pk, None)
+        if desc is None and pk in failing:
+            # The process failed by itself
+            desc = {k:info[k] for k in ('pk', 'process_label', 'process_state', 'exit_status', 'exit_message', 'state')}
+        info['failing'] = desc
+        info['action_result'] = None
+        info['result']  = None
+
+        if info['state'] == 'failed' and desc is not None and desc['process_label'] in actions:
+            info['action_result'] = actions[desc['process_label']](load_node(desc['pk']))
+
+        callback = callbacks[info['state']]
+        if not callback is None:
+            info['result'] = callback(load_node(pk))
+
+    if summary:
+        print_scan_summary(infos)
+
+    return infos
+
+def print_scan_summary(infos):
+    """Print the summary table of the output of `scan_workchains`."""
+    counts = {}
+    for info in infos.values():
+        counts[info['state']] = counts.get(info['state'], 0) + 1
+    print('Scanned {} processes: {}'.format(
+        len(infos), ', '.join('{} {}'.format(v, k) for k,v in sorted(counts.items()))
+        ))
+
+    rows = [info for info in infos.values() if info['state'] in ('failed', 'excepted', 'killed')]
+    if not rows:
+        return
+
+    print('{:>8s}  {:<30s}  {:<10s}  {:>6s}  {}'.format('pk', 'process', 'state', 'exit', 'failing descendant'))
+    for info in sorted(rows, key=lambda x: x['pk']):
+        desc = info['failing']
+        if desc is None:
+            desc_str = '-'
+        else:
+            desc_str = '{}<{}>: [{}] {}'.format(
+                desc['process_label'], desc['pk'], desc['exit_status'], desc['exit_message'] or ''
+                )
+        print('{:>8d}  {:<30s}  {:<10s}  {:>6s}  {}'.format(
+            info['pk'], str(info['process_label']), info['state'], str(info['exit_status']), desc_str
+            ))
@@ -1,60 +1,143 @@
+from collections import OrderedDict
+
 import numpy as np
 
 from aiida import orm
 from aiida.engine import calcfunction
 
-save = {
-    # 12523: {(2,1,1): load_node(36758)},
-    # 12155: {(2,1,1): load_node(36764)}
-    }
-def make_supercell(structure, supercell):
-    if not isinstance(supercell, orm.ArrayData):
-        app = orm.ArrayData()
-        app.set_array('data', np.array(supercell))
-        supercell = app
-    pk = structure.pk
-    sc = tuple(supercell.get_array('data'))
-    if pk in save:
-        if sc in save[pk]:
-            return save[pk][sc]
+CACHE_SIZE = 128
+_cache = OrderedDict()
+
+def _get_supercell_node(supercell, mag_atoms=()):
+    if isinstance(supercell, orm.ArrayData):
+        if len(mag_atoms):
+            raise ValueError('`mag_atoms` can not be given together with a `supercell` ArrayData: set its `mag_atoms` array instead.')
+        return supercell
+    res = orm.ArrayData()
+    res.set_array('data', np.array(supercell, dtype=int))
+    res.set_array('mag_atoms', np.array(sorted(set(mag_atoms)), dtype=str))
+    return res
+
+def _query_supercell(structure, supercell_hash):
+    """Find the output of a previous `_make_supercell` run with the same inputs."""
+    qb = orm.QueryBuilder()
+    qb.append(orm.StructureData, filters={'uuid': structure.uuid}, tag='structure')
+    qb.append(
+        orm.CalcFunctionNode, with_incoming='structure', tag='calc',
+        edge_filters={'label': 'structure'},
+        filters={
+            'attributes.function_name': '_make_supercell',
+            'attributes.exit_status': 0,
+            },
+        )
+    qb.append(
+        orm.ArrayData, with_outgoing='calc',
+        edge_filters={'label': 'supercell'},
+        filters={'extras._aiida_hash': supercell_hash},
+        )
+    qb.append(orm.StructureData, with_incoming='calc', tag='result', project='*')
+    qb.order_by({'result': {'id': 'asc'}})
+
+    res = qb.first()
+    if res is None:
+        return None
+    return res[0]
 
-    res = _make_supercell(structure, supercell)
+def make_supercell(structure, supercell, mag_atoms=(), use_cache=True):
+    """Create a supercell of `structure` through the `_make_supercell` calcfunction.
 
-    if not pk in save:
-        save[pk] = {}
-    save[pk][sc] = res
+    Params:
+     - structure: StructureData to replicate.
+     - supercell: 3 integers (or ArrayData with arrays 'data' and 'mag_atoms') with the repetitions along every cell vector.
+     - mag_atoms: names of the kinds that are given a different name for every replica.
+                  Only valid if `supercell` is not an ArrayData (whose own `mag_atoms` array is used), otherwise
+                  a ValueError is raised.
+     - use_cache: If True, look for the result of an identical previous call, first in an in-process LRU cache,
+                  then in the database (matching structure UUID and hash of the supercell ArrayData),
+                  before creating a new calcfunction node.
+    """
+    supercell = _get_supercell_node(supercell, mag_atoms)
+
+    if not use_cache or not structure.is_stored:
+        return _make_supercell(structure, supercell)
+
+    if supercell.is_stored:
+        sc_hash = supercell.get_extra('_aiida_hash', None) or supercell.get_hash()
+    else:
+        sc_hash = supercell.get_hash()
+    key = (structure.uuid, sc_hash)
+
+    if key in _cache:
+        _cache.move_to_end(key)
+        return _cache[key]
+
+    res = _query_supercell(structure, sc_hash)
+    if res is None:
+        res = _make_supercell(structure, supercell)
+
+    _cache[key] = res
+    if len(_cache) > CACHE_SIZE:
+        _cache.popitem(last=False)
 
     return res
 
-@calcfunction
-def _make_supercell(structure, supercell):
-    from itertools import product
-    mag_atoms = supercell.get_array('mag_atoms')
-    sc = tuple(supercell.get_array('data'))
+def _supercell_sites(cell, positions, kind_names, sc, mag_atoms=()):
+    """Compute the sites of the supercell with a single broadcast.
+
+    The sites are ordered as for a loop over the replicas (outer) and over the sites (inner).
+    The kinds in `mag_atoms` get a progressive counter appended to their name.
+
+    Return:
+     (#sc*#nat,3) shaped array of positions, list of the new kind names and list of (new, original) kind names
+     in order of first appearance.
+    """
     x,y,z = sc
-    grid = np.array(list(product(range(x), range(y), range(z))))
+    grid = np.indices((x,y,z)).reshape(3,-1).T
 
-    cell = structure.cell
+    new_pos = (grid.dot(cell)[:, np.newaxis, :] + positions[np.newaxis, :, :]).reshape(-1,3)
 
-    new = orm.StructureData()
-    new.set_cell((np.array(cell).T * sc).T)
+    orig_names = np.tile(np.array(kind_names, dtype=str), grid.shape[0])
+    new_names  = orig_names.astype(object)
+    for name in set(mag_atoms):
+        mask = orig_names == name
+        if not mask.any():
+            continue
+        counter = np.arange(1, mask.sum()+1).astype(str).astype(object)
+        new_names[mask] = name + counter
+
+    _, first = np.unique(new_names.astype(str), return_index=True)
+    first.sort()
+    kinds = [(new_names[i], orig_names[i]) for i in first]
 
-    kinds = structure.kinds
-    sites = structure.sites
+    return new_pos, new_names.tolist(), kinds
 
-    counter = {k.name:0 for k in kinds}
+@calcfunction
+def _make_supercell(structure, supercell):
+    if 'mag_atoms' in supercell.get_arraynames():
+        mag_atoms = supercell.get_array('mag_atoms')
+    else:
+        mag_atoms = ()
+    sc = tuple(supercell.get_array('data'))
 
-    for R_cryst in grid:
-        for n,site in enumerate(sites):
-            pos = np.array(site.position) + np.dot(R_cryst, cell)
-            name = site.kind_name
+    cell      = np.array(structure.cell)
+    sites     = structure.sites
+    positions = np.array([site.position for site in sites], dtype=float).reshape(-1,3)
+    names     = [site.kind_name for site in sites]
+
+    new_pos, new_names, new_kinds = _supercell_sites(cell, positions, names, sc, mag_atoms)
+
+    new = orm.StructureData()
+    new.set_cell((cell.T * sc).T)
 
-            counter[name] += 1
+    kinds = []
+    for new_name, name in new_kinds:
+        raw = dict(structure.get_kind(name).get_raw())
+        raw['name'] = new_name
+        kinds.append(raw)
 
-            new.append_atom(
-                position=pos,
-                symbols=name,
-                name=f'{name}{counter[name] if name in mag_atoms else ""}',
-                )
+    new.set_attribute('kinds', kinds)
+    new.set_attribute('sites', [
+        {'position': tuple(pos), 'kind_name': name} for pos,name in zip(new_pos.tolist(), new_names)
+        ])
 
-    return new
\ No newline at end of file
+    return new
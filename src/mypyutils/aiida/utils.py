@@ -1,3 +1,9 @@
+import os
+import shlex
+import multiprocessing
+from contextlib import contextmanager
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+
 from aiida import orm
 from aiida.orm.utils import load_node
 from aiida.cmdline.utils.common import get_workchain_report
@@ -24,33 +30,297 @@ def report_failed(node, tab='', actions={}):
         if failed_node.process_class == typ:
             return act(failed_node)
 
-def report_running(node):
-    print(get_workchain_report(node, 'REPORT'))
+STATUS_MESSAGES = {
+    'no-desc': 'NO CALLED DESC',
+    'no-calcjob': 'NO CALCJOB',
+    'no-remote': 'NO REMOTE YET!!!',
+    'queued': 'IN QUEUE',
+    'running': 'RUNNING',
+    'error': 'REMOTE NOT ACCESSIBLE',
+    }
 
-    desc = list(node.called_descendants)
-    if not len(desc):
-        print('_____________________________________ NO CALLED DESC')
-        return
-    desc.sort(key=lambda x: x.pk)
-    last = desc[-1]
+REPORT_CURSOR_EXTRA = 'report_cursor'
+_report_cursors = {}
 
-    if not isinstance(last, orm.CalcJobNode):
-        print('_____________________________________ NO CALCJOB')
-        return
+PROCESS_PROJECTIONS = {
+    'pk': 'id',
+    'node_type': 'node_type',
+    'process_label': 'attributes.process_label',
+    'process_state': 'attributes.process_state',
+    'exit_status': 'attributes.exit_status',
+    'exit_message': 'attributes.exit_message',
+    }
 
-    try:
-        remote = last.outputs.remote_folder
-    except:
-        print('_____________________________________ NO REMOTE YET!!!')
-        return
+def _get_state(process_state, exit_status):
+    if process_state == 'finished':
+        return 'finished_ok' if exit_status == 0 else 'failed'
+    if process_state in ('killed', 'excepted'):
+        return process_state
+    return 'running'
+
+def _process_info(row):
+    res = dict(zip(PROCESS_PROJECTIONS, row))
+    res['state'] = _get_state(res['process_state'], res['exit_status'])
+    res['is_calcjob'] = res['node_type'].startswith('process.calculation.calcjob.')
+    return res
+
+def query_processes(pks, chunk_size=1000):
+    """Return the state of the processes `pks` as a dictionary {pk: info}.
+
+    `info` contains the projected PROCESS_PROJECTIONS, the `state` (killed, finished_ok, failed, excepted,
+    running) and whether the process is a CalcJob.
+    """
+    res = {}
+    for i in range(0, len(pks), chunk_size):
+        qb = orm.QueryBuilder()
+        qb.append(orm.ProcessNode, filters={'id': {'in': pks[i:i+chunk_size]}}, project=list(PROCESS_PROJECTIONS.values()))
+        for row in qb.iterall():
+            info = _process_info(row)
+            res[info['pk']] = info
+    return res
+
+def query_called(pks, chunk_size=1000):
+    """Return the processes called by `pks` as a dictionary {parent pk: [child info, ...]} (see `query_processes`)."""
+    res = {}
+    for i in range(0, len(pks), chunk_size):
+        qb = orm.QueryBuilder()
+        qb.append(orm.ProcessNode, filters={'id': {'in': pks[i:i+chunk_size]}}, tag='parent', project='id')
+        qb.append(
+            orm.ProcessNode, with_incoming='parent', project=list(PROCESS_PROJECTIONS.values()),
+            edge_filters={'type': {'in': ['call_calc', 'call_work']}},
+            )
+        for parent, *row in qb.iterall():
+            res.setdefault(parent, []).append(_process_info(row))
+    return res
+
+def get_called_descendants(pks, chunk_size=1000):
+    """Return the called descendants of `pks` as {root pk: [child info, ...]}, with one query per call level."""
+    res  = {pk:[] for pk in pks}
+    ptrs = {pk:[pk] for pk in pks}
+    while ptrs:
+        called = query_called(list({p for lst in ptrs.values() for p in lst}), chunk_size)
+
+        new = {}
+        for root, lst in ptrs.items():
+            children = [c for p in lst for c in called.get(p, [])]
+            if children:
+                res[root].extend(children)
+                new[root] = [c['pk'] for c in children]
+        ptrs = new
+
+    return res
+
+def get_new_reports(nodes, levelname='REPORT', use_extras=False, cursors=None, update=True):
+    """Fetch only the log entries of `nodes` (and their called descendants) added since the last call.
+
+    The id of the last seen log entry of every node is stored in the node extras (`use_extras=True`)
+    or in the `cursors` dictionary (default: a module level dictionary, lost on restart).
 
-    pc = last.process_class
-    files = remote.listdir()
+    Params:
+     - nodes: list of nodes/pks.
+     - levelname: minimum level of the log entries.
+     - update: If False, do not move the cursors forward.
+    Return:
+     Dictionary {pk: list of (id, node pk, time, levelname, message) tuples}.
+    """
+    from aiida.common.log import LOG_LEVELS
 
-    if pc._DEFAULT_OUTPUT_FILE not in files:
-        print('_____________________________________ IN QUEUE')
+    if cursors is None:
+        cursors = _report_cursors
+    nodes  = [validate_node(node) for node in nodes]
+    levels = [name for name, lvl in LOG_LEVELS.items() if lvl >= LOG_LEVELS[levelname]]
+
+    start = {}
+    for node in nodes:
+        if use_extras:
+            start[node.pk] = node.get_extra(REPORT_CURSOR_EXTRA, 0)
+        else:
+            start[node.pk] = cursors.get(node.uuid, 0)
+
+    owner = {pk:[pk] for pk in start}
+    for root, lst in get_called_descendants(list(start)).items():
+        for info in lst:
+            owner.setdefault(info['pk'], []).append(root)
+
+    res = {pk:[] for pk in start}
+    if start:
+        owned = list(owner)
+        for i in range(0, len(owned), 1000):
+            qb = orm.QueryBuilder()
+            qb.append(
+                orm.Log,
+                filters={
+                    'dbnode_id': {'in': owned[i:i+1000]},
+                    'id': {'>': min(start.values())},
+                    'levelname': {'in': levels},
+                    },
+                project=['id', 'dbnode_id', 'time', 'levelname', 'message'],
+                )
+            for entry in qb.iterall():
+                for root in owner[entry[1]]:
+                    if entry[0] > start[root]:
+                        res[root].append(tuple(entry))
+        for entries in res.values():
+            entries.sort()
+
+    if update:
+        for node in nodes:
+            if not res[node.pk]:
+                continue
+            last = res[node.pk][-1][0]
+            if use_extras:
+                node.set_extra(REPORT_CURSOR_EXTRA, last)
+            else:
+                cursors[node.uuid] = last
+
+    return res
+
+def report_new(nodes, tab='', **kwargs):
+    """Print only the log entries of `nodes` added since the last call (see `get_new_reports`)."""
+    if isinstance(nodes, (int, orm.Node)):
+        nodes = [nodes]
+    for pk, entries in get_new_reports(nodes, **kwargs).items():
+        if len(nodes) > 1:
+            print(tab + '{} new report entries for <{}>'.format(len(entries), pk))
+        for _, node_pk, time, level, message in entries:
+            print(tab + '{:%Y-%m-%d %H:%M:%S} [{} | {}]: {}'.format(time, node_pk, level, message))
+
+def report_running(node, incremental=False):
+    if incremental:
+        report_new([node])
     else:
-        print('_____________________________________ RUNNING')
+        print(get_workchain_report(node, 'REPORT'))
+
+    status = probe_remote_folders([node])[node.pk]
+    print('_____________________________________ ' + STATUS_MESSAGES[status])
+
+def _list_folders(transport, jobs):
+    """List the remote folders of `jobs` ((pk, path, output file) tuples) reusing a single open transport."""
+    res = {}
+    with transport:
+        for pk, path, output in jobs:
+            try:
+                files = transport.listdir(path)
+            except (IOError, OSError):
+                res[pk] = 'error'
+                continue
+            res[pk] = 'running' if output in files else 'queued'
+    return res
+
+def classify_remote_folders(jobs, transports, max_workers=None):
+    """List the remote folders grouped by computer, concurrently across computers.
+
+    Params:
+     - jobs: dictionary {computer key: [(pk, remote path, output filename), ...]}.
+     - transports: dictionary {computer key: transport}, every transport is opened once for all its jobs.
+     - max_workers: maximum number of computers probed concurrently.
+    Return:
+     Dictionary {pk: status}, with status 'running' if the output file is present, 'queued' if not,
+     'error' if the folder is not accessible.
+    """
+    res = {}
+    if not jobs:
+        return res
+    with ThreadPoolExecutor(max_workers=max_workers) as pool:
+        futures = [pool.submit(_list_folders, transports[key], lst) for key, lst in jobs.items()]
+        for fut in futures:
+            res.update(fut.result())
+    return res
+
+def _query_remote_folders(pks, chunk_size=1000):
+    """Return {calcjob pk: (calcjob, remote_folder RemoteData, computer uuid)} for the calcjobs that have one."""
+    res = {}
+    for i in range(0, len(pks), chunk_size):
+        qb = orm.QueryBuilder()
+        qb.append(orm.CalcJobNode, filters={'id': {'in': pks[i:i+chunk_size]}}, tag='calc', project='*')
+        qb.append(orm.RemoteData, with_incoming='calc', tag='remote', project='*', edge_filters={'label': 'remote_folder'})
+        qb.append(orm.Computer, with_node='remote', project='uuid')
+        for calc, remote, uuid in qb.iterall():
+            res[calc.pk] = (calc, remote, uuid)
+    return res
+
+def probe_remote_folders(nodes, max_workers=None):
+    """Classify running workchains/calcjobs as queued/running by listing the remote folder of their last CalcJob.
+
+    The last CalcJob of every node is found with one query per call level for all the nodes, and the
+    remote folders with a single query. The calculations are then grouped by computer: a single transport
+    is opened for every computer, and the different computers are probed concurrently in a thread pool.
+
+    Params:
+     - nodes: Group, QueryBuilder or list of nodes/pks (workchains or calcjobs).
+     - max_workers: maximum number of computers probed concurrently.
+    Return:
+     Dictionary {pk: status}, with status one of 'queued', 'running', 'no-remote', 'no-calcjob', 'no-desc'
+     or 'error' (remote folder not accessible).
+    """
+    pks   = get_pks(nodes)
+    infos = query_processes(pks)
+    desc  = get_called_descendants([pk for pk in pks if not infos[pk]['is_calcjob']])
+
+    res  = {}
+    last = {}
+    for pk in pks:
+        if infos[pk]['is_calcjob']:
+            last[pk] = pk
+        elif not desc[pk]:
+            res[pk] = 'no-desc'
+        else:
+            child = max(desc[pk], key=lambda c: c['pk'])
+            if child['is_calcjob']:
+                last[pk] = child['pk']
+            else:
+                res[pk] = 'no-calcjob'
+
+    remotes    = _query_remote_folders(list(set(last.values())))
+    jobs       = {}
+    transports = {}
+    for pk, calc_pk in last.items():
+        if not calc_pk in remotes:
+            res[pk] = 'no-remote'
+            continue
+        calc, remote, uuid = remotes[calc_pk]
+        output = calc.get_option('output_filename') or calc.process_class._DEFAULT_OUTPUT_FILE
+        if not uuid in transports:
+            transports[uuid] = remote.get_authinfo().get_transport()
+        jobs.setdefault(uuid, []).append((pk, remote.get_remote_path(), output))
+
+    res.update(classify_remote_folders(jobs, transports, max_workers))
+
+    return res
+
+def tail_remote(remote, filename, n=20, tab=''):
+    """Same as `tail` for a file inside a RemoteData folder, without copying the whole file.
+
+    The last lines are extracted on the remote computer with `tail`.
+    """
+    path = os.path.join(remote.get_remote_path(), filename)
+    with remote.get_authinfo().get_transport() as transport:
+        retval, stdout, stderr = transport.exec_command_wait('tail -n {} {}'.format(int(n), shlex.quote(path)))
+    if retval:
+        raise IOError('Failed to read `{}`: {}'.format(path, stderr))
+
+    return ('\n'+tab).join(stdout.rstrip('\n').split('\n'))
+
+def _init_aiida_worker(profile, initializer=None, initargs=()):
+    from aiida import load_profile
+    load_profile(profile)
+    if not initializer is None:
+        initializer(*initargs)
+
+def get_process_pool(processes=None, initializer=None, initargs=()):
+    """Create a ProcessPoolExecutor whose (spawned) workers load the currently loaded aiida profile.
+
+    Params:
+     - processes: number of worker processes (None = number of CPUs).
+     - initializer, initargs: additional initializer run in every worker after loading the profile.
+    """
+    from aiida.manage.configuration import get_profile
+    return ProcessPoolExecutor(
+        max_workers=processes,
+        mp_context=multiprocessing.get_context('spawn'),
+        initializer=_init_aiida_worker,
+        initargs=(get_profile().name, initializer, initargs),
+        )
 
 def validate_node(node):
     if isinstance(node, int):
@@ -60,4 +330,37 @@ def validate_node(node):
     else:
         raise ValueError('`pk` must be either a aiida.orm.Node or a pk to a node')
 
-    return res
\ No newline at end of file
+    return res
+
+def get_pks(nodes, node_class=orm.Node):
+    """Return the list of pks of `nodes`.
+
+    Params:
+     - nodes: Group, QueryBuilder (projecting nodes or pks) or list of nodes/pks.
+     - node_class: class of the nodes of a Group to select. Default = orm.Node
+    """
+    if isinstance(nodes, orm.Group):
+        qb = orm.QueryBuilder()
+        qb.append(orm.Group, filters={'id': nodes.pk}, tag='group')
+        qb.append(node_class, with_group='group', project='id')
+        return qb.all(flat=True)
+    if isinstance(nodes, orm.QueryBuilder):
+        nodes = nodes.all(flat=True)
+    return [n.pk if isinstance(n, orm.Node) else int(n) for n in nodes]
+
+@contextmanager
+def atomic_open(fname, mode='w'):
+    """Open `fname + '.tmp'` for writing and move it to `fname` only once it has been written successfully.
+
+    Readers never see a partially written file, and the temporary file is removed on errors.
+    """
+    os.makedirs(os.path.dirname(fname) or '.', exist_ok=True)
+    tmp = fname + '.tmp'
+    try:
+        with open(tmp, mode) as f:
+            yield f
+        os.replace(tmp, fname)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+        raise
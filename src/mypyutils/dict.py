@@ -1,8 +1,10 @@
+from collections.abc import Mapping
+
 def dict_str(dct, tab=''):
     res = [tab + '{']
     tab += '  '
     for k,v in dct.items():
-        if isinstance(v, dict):
+        if isinstance(v, Mapping):
             new = dict_str(v, tab).strip()
         else:
             new = v
@@ -12,24 +14,190 @@ def dict_str(dct, tab=''):
     return '\n'.join(res)
 
 def deep_copy(old):
-    res = {}
-    for k,v in old.items():
-        if not isinstance(v, dict):
-            res[k] = v
-        else:
-            res[k] = deep_copy(v)
+    """Copy nested dictionaries (non-dict values are not copied)"""
+    res = dict(old)
+    stack = [res]
+    while stack:
+        dst = stack.pop()
+        for k,v in dst.items():
+            if isinstance(v, dict):
+                v = dst[k] = dict(v)
+                stack.append(v)
 
     return res
 
 def deep_update(old, new, overwrite=True):
-    """Update nested dictionaries"""
-    if not overwrite:
-        res = deep_copy(old)
-    else:
-        res = old
-    for k,v in new.items():
-        if isinstance(v, dict) and k in res and isinstance(res[k], dict):
-            deep_update(res[k], v)
-        else:
-            res[k] = v  
-    return res
\ No newline at end of file
+    """Update nested dictionaries
+
+    If `overwrite` is False, `old` is left untouched and only the dictionaries along the paths modified
+    by `new` are copied (copy-on-write): the unmodified sub-dictionaries are shared between `old` and the result.
+    """
+    res = old if overwrite else dict(old)
+    stack = [(res, new)]
+    while stack:
+        dst, src = stack.pop()
+        for k,v in src.items():
+            if isinstance(v, dict):
+                sub = dst.get(k, None)
+                if isinstance(sub, dict):
+                    if not overwrite:
+                        sub = dst[k] = dict(sub)
+                    stack.append((sub, v))
+                    continue
+            dst[k] = v
+    return res
+
+def _freeze(value):
+    if isinstance(value, FrozenDict):
+        return value
+    if isinstance(value, dict):
+        return FrozenDict(value)
+    if isinstance(value, (list, tuple)):
+        return tuple(_freeze(v) for v in value)
+    if isinstance(value, set):
+        return frozenset(_freeze(v) for v in value)
+    return value
+
+def _thaw(value):
+    if isinstance(value, FrozenDict):
+        return value.to_dict()
+    if isinstance(value, tuple):
+        return [_thaw(v) for v in value]
+    if isinstance(value, frozenset):
+        return {_thaw(v) for v in value}
+    return value
+
+class FrozenDict(Mapping):
+    """Immutable nested mapping with structural sharing.
+
+    Nested dictionaries are converted to FrozenDict, lists/tuples to tuples and sets to frozensets.
+    `with_path`/`without_path`/`merge` return new maps that reuse all the untouched sub-maps, and the
+    hash is computed once and cached, so that parameter variants can be cheaply generated and used as
+    cache keys.
+    Use `to_dict` to get back a plain nested dictionary (tuples are converted to lists).
+    """
+    __slots__ = ('_data', '_hash')
+
+    def __init__(self, *args, **kwargs):
+        self._data = {k:_freeze(v) for k,v in dict(*args, **kwargs).items()}
+        self._hash = None
+
+    @classmethod
+    def _from_frozen(cls, data):
+        res = cls.__new__(cls)
+        res._data = data
+        res._hash = None
+        return res
+
+    def __getitem__(self, key):
+        return self._data[key]
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def __hash__(self):
+        if self._hash is None:
+            self._hash = hash(frozenset(self._data.items()))
+        return self._hash
+
+    def __eq__(self, other):
+        if self is other:
+            return True
+        if isinstance(other, FrozenDict):
+            if self._hash is not None and other._hash is not None and self._hash != other._hash:
+                return False
+            return self._data == other._data
+        if isinstance(other, Mapping):
+            return self._data == FrozenDict(other)._data
+        return NotImplemented
+
+    def __ne__(self, other):
+        res = self.__eq__(other)
+        if res is NotImplemented:
+            return res
+        return not res
+
+    def __repr__(self):
+        return '{}({!r})'.format(type(self).__name__, self._data)
+
+    @staticmethod
+    def _split_path(path):
+        if isinstance(path, str):
+            return (path,)
+        path = tuple(path)
+        if not path:
+            raise ValueError('`path` must contain at least one key')
+        return path
+
+    def get_path(self, path, default=None):
+        """Get the value at `path` (tuple of keys), or `default` if not present."""
+        ptr = self
+        for k in self._split_path(path):
+            if not isinstance(ptr, FrozenDict) or not k in ptr._data:
+                return default
+            ptr = ptr._data[k]
+        return ptr
+
+    def with_path(self, path, value):
+        """Return a new map with `value` set at `path` (tuple of keys), creating the missing levels.
+
+        Only the maps along `path` are copied, all the other sub-maps are shared with `self`.
+        """
+        path  = self._split_path(path)
+        nodes = [self]
+        for k in path[:-1]:
+            nxt = nodes[-1]._data.get(k, None)
+            if not isinstance(nxt, FrozenDict):
+                nxt = FrozenDict()
+            nodes.append(nxt)
+
+        new = _freeze(value)
+        for node, k in zip(reversed(nodes), reversed(path)):
+            data    = dict(node._data)
+            data[k] = new
+            new = self._from_frozen(data)
+
+        return new
+
+    def without_path(self, path):
+        """Return a new map without the key at `path` (tuple of keys). Return `self` if not present."""
+        path  = self._split_path(path)
+        nodes = [self]
+        for k in path[:-1]:
+            nxt = nodes[-1]._data.get(k, None)
+            if not isinstance(nxt, FrozenDict):
+                return self
+            nodes.append(nxt)
+        if not path[-1] in nodes[-1]._data:
+            return self
+
+        data = dict(nodes[-1]._data)
+        del data[path[-1]]
+        new = self._from_frozen(data)
+        for node, k in zip(reversed(nodes[:-1]), reversed(path[:-1])):
+            data    = dict(node._data)
+            data[k] = new
+            new = self._from_frozen(data)
+
+        return new
+
+    def merge(self, other):
+        """Return a new map deep-updated with `other` (same semantic of `deep_update`)."""
+        data = dict(self._data)
+        for k,v in other.items():
+            old = data.get(k, None)
+            if isinstance(old, FrozenDict) and isinstance(v, Mapping):
+                data[k] = old.merge(v)
+            else:
+                data[k] = _freeze(v)
+        return self._from_frozen(data)
+
+    def to_dict(self):
+        """Convert to a plain nested dictionary."""
+        return {k:_thaw(v) for k,v in self._data.items()}
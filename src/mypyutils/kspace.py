@@ -0,0 +1,93 @@
+from itertools import product, chain
+
+import numpy as np
+from scipy.spatial import cKDTree
+
+def recipr_base(base):
+    return np.linalg.inv(base).T * 2 * np.pi
+
+class PeriodicKTree():
+    """KD-tree index of a set of k-points aware of the periodicity of the reciprocal lattice.
+
+    The k-points are folded once inside the unit cell spanned by `recipr` and every query point
+    is matched against its periodic images, so that distances follow the minimum image convention
+    without building replicas of the (possibly huge) k-point mesh.
+    The indexes returned by the queries refer to the original ordering of `kpt_cart`.
+
+    Params:
+     - kpt_cart: (#nkpt,3) shaped array of kpoints in cartesian coordinates.
+     - recipr: matrix of the 3 reciprocal space basis vectors as rows.
+     - images: number of neighbouring cells to consider along every direction. Default = 1
+               (enough for any radius smaller than half of the shortest reciprocal vector).
+    """
+    def __init__(self, kpt_cart, recipr, images=1):
+        self.recipr  = np.array(recipr, dtype=float)
+        self.irecipr = np.linalg.inv(self.recipr)
+
+        kpt_cart = np.array(kpt_cart, dtype=float).reshape(-1,3)
+        self.n_kpt = kpt_cart.shape[0]
+        self.tree  = cKDTree(self.fold(kpt_cart))
+
+        rng = range(-images, images+1)
+        self.shifts = np.array(list(product(rng, rng, rng)), dtype=float).dot(self.recipr)
+
+        # Longest distance between two points of the unit cell: any radius above it contains all the k-points
+        corners = np.array(list(product([-1, 1], repeat=3)), dtype=float).dot(self.recipr)
+        self.diameter = np.linalg.norm(corners, axis=1).max()
+
+    def fold(self, kpt_cart):
+        """Bring the cartesian k-points inside the first unit cell of the reciprocal lattice."""
+        kpt_cryst  = np.array(kpt_cart, dtype=float).reshape(-1,3).dot(self.irecipr)
+        kpt_cryst -= np.floor(kpt_cryst)
+        return kpt_cryst.dot(self.recipr)
+
+    def _images(self, points):
+        points = self.fold(points)
+        return (points[:, np.newaxis, :] + self.shifts[np.newaxis, :, :]).reshape(-1,3)
+
+    def query_ball_point(self, points, r):
+        """Find the k-points within distance `r` of `points`.
+
+        Params:
+         - points: (#npt,3) shaped array of cartesian coordinates.
+         - r: radius or (#npt) shaped array of radii.
+        Return:
+         List of #npt sorted arrays of k-point indexes.
+        Points with a radius larger than the cell `diameter` select all the k-points without any query.
+        """
+        points = np.array(points, dtype=float).reshape(-1,3)
+        n_pts  = points.shape[0]
+        n_img  = self.shifts.shape[0]
+        radii  = np.broadcast_to(np.array(r, dtype=float), (n_pts,))
+
+        res = [None] * n_pts
+        every = radii >= self.diameter
+        for i in np.where(every)[0]:
+            res[i] = np.arange(self.n_kpt)
+
+        todo = np.where(~every)[0]
+        if len(todo):
+            query = self.tree.query_ball_point(self._images(points[todo]), np.repeat(radii[todo], n_img))
+            for n, i in enumerate(todo):
+                found = chain.from_iterable(query[n*n_img:(n+1)*n_img])
+                res[i] = np.unique(np.fromiter(found, dtype=int))
+
+        return res
+
+    def query(self, points):
+        """Find the nearest k-point to every one of `points`.
+
+        Return:
+         (#npt) shaped arrays of minimum image distances and k-point indexes.
+        """
+        points = np.array(points, dtype=float).reshape(-1,3)
+        n_img  = self.shifts.shape[0]
+
+        dist, idx = self.tree.query(self._images(points))
+        dist = dist.reshape(-1, n_img)
+        idx  = idx.reshape(-1, n_img)
+
+        best = dist.argmin(axis=1)
+        rows = np.arange(dist.shape[0])
+
+        return dist[rows, best], idx[rows, best]
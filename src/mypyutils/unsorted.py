@@ -1,6 +1,99 @@
+import os
+import time
+from collections import deque
+
 def tail(content, n=20, tab=''):
     s = content.split('\n')
 
     filtered = s[-n:]
 
-    return ('\n'+tab).join(filtered)
\ No newline at end of file
+    return ('\n'+tab).join(filtered)
+
+def _tail_lines(f, n, block_size=4096):
+    """Return the last `n` newline-separated chunks of a binary file handle, reading backwards in blocks."""
+    if not f.seekable():
+        # Stream forward keeping only the last lines
+        res = deque([b''], maxlen=n)
+        for line in f:
+            parts = (res.pop() + line).split(b'\n')
+            res.extend(parts)
+        return list(res)
+
+    f.seek(0, os.SEEK_END)
+    pos  = f.tell()
+    data = b''
+    while pos > 0 and data.count(b'\n') < n:
+        step = min(block_size, pos)
+        pos -= step
+        f.seek(pos)
+        data = f.read(step) + data
+
+    return data.split(b'\n')[-n:]
+
+def tail_file(f, n=20, tab='', block_size=4096, encoding='utf-8'):
+    """Same as `tail`, but on a file without reading it entirely.
+
+    Params:
+     - f: path or binary file handle (e.g. from `node.open(name, 'rb')`).
+     - n: number of lines.
+     - block_size: size of the blocks read backwards from the end of the file.
+    """
+    if n <= 0:
+        return ''
+    if isinstance(f, (str, bytes, os.PathLike)):
+        with open(f, 'rb') as handle:
+            lines = _tail_lines(handle, n, block_size)
+    else:
+        lines = _tail_lines(f, n, block_size)
+
+    return ('\n'+tab).join(l.decode(encoding, errors='replace') for l in lines)
+
+def read_new_lines(path, offset=0, encoding='utf-8'):
+    """Read the complete lines added to `path` after `offset`.
+
+    Return:
+     List of new lines and the offset to use for the next call (the start of a trailing incomplete line).
+    """
+    with open(path, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        if f.tell() < offset:
+            # File truncated or rotated
+            offset = 0
+        f.seek(offset)
+        data = f.read()
+
+    end = data.rfind(b'\n') + 1
+    lines = data[:end].split(b'\n')[:-1]
+
+    return [l.decode(encoding, errors='replace') for l in lines], offset + end
+
+def follow_file(path, offset=None, n=0, interval=1.0, timeout=None, encoding='utf-8'):
+    """Generator yielding the new lines of `path` as they are written (like `tail -f`).
+
+    Params:
+     - offset: byte offset to start from. Default = end of the last complete line of the file
+               (a trailing incomplete line is yielded once completed).
+     - n: number of lines before `offset` to yield first (only if `offset` is None).
+     - interval: polling interval in seconds.
+     - timeout: stop after this many seconds without new lines. Default = never.
+    Yield:
+     (line, offset) tuples, where offset can be saved and passed back to resume following the file later.
+    """
+    if offset is None:
+        with open(path, 'rb') as f:
+            # Last n complete lines and the (possibly empty) trailing incomplete one
+            lines = _tail_lines(f, n + 1, 4096)
+            offset = f.seek(0, os.SEEK_END) - len(lines[-1])
+        for line in lines[:-1]:
+            yield line.decode(encoding, errors='replace'), offset
+
+    last = time.time()
+    while True:
+        lines, offset = read_new_lines(path, offset, encoding=encoding)
+        for line in lines:
+            yield line, offset
+        if lines:
+            last = time.time()
+        elif timeout is not None and time.time() - last > timeout:
+            return
+        time.sleep(interval)
@@ -1,4 +1,5 @@
 from .dos import DosWorkChain, DosWorkChain_cropped
 from .pw2gw import Pw2gwWorkChain
 from .my_bands import MyPwBandsWorkChain
-from .pp_wfc import PPwfcWorkChain
\ No newline at end of file
+from .pp_wfc import PPwfcWorkChain, iter_wfc_data
+from .batched_pw import BatchedPwBaseWorkChain
\ No newline at end of file
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""Workchain to run a PwBaseWorkChain on an explicit list of k-points split in parallel batches."""
+from aiida import orm
+from aiida.common import AttributeDict
+from aiida.plugins import WorkflowFactory
+from aiida.engine import WorkChain, ToContext, calcfunction
+
+from aiida_quantumespresso.utils.mapping import prepare_process_inputs
+
+from .kpoint_grids import kpt_split, bands_merge
+
+PwBaseWorkChain = WorkflowFactory('quantumespresso.pw.base')
+
+
+def validate_inputs(inputs, ctx=None):  # pylint: disable=unused-argument
+    """Validate the inputs of the entire input namespace."""
+    if 'max_kpoints_per_batch' in inputs:
+        return
+    if not all(key in inputs for key in ['target_walltime', 'walltime_per_kpoint']):
+        return 'Specify either `max_kpoints_per_batch` or both `target_walltime` and `walltime_per_kpoint`.'
+
+
+def validate_kpoints(value, ctx=None):  # pylint: disable=unused-argument
+    """Validate that the `kpoints` are an explicit list and not a mesh."""
+    try:
+        value.get_kpoints()
+    except AttributeError:
+        return '`kpoints` must be an explicit list of k-points, a mesh can not be split in batches.'
+
+
+@calcfunction
+def merge_output_parameters(**kwargs) -> orm.Dict:
+    """Merge the output parameters of the batches.
+
+    The parameters of the first batch are kept, with the number of k-points and the wall time summed over all batches.
+    """
+    labels = sorted(kwargs)
+    params = [kwargs[label].get_dict() for label in labels]
+
+    res = params[0]
+    for key in ['number_of_k_points', 'wall_time_seconds']:
+        if key in res:
+            res[key] = sum(p.get(key, 0) for p in params)
+    res['number_of_batches'] = len(labels)
+
+    return orm.Dict(dict=res)
+
+
+def get_batched_inputs(inputs, **kwargs):
+    """Convert the (prepared) inputs of a PwBaseWorkChain into the inputs of a `BatchedPwBaseWorkChain`.
+
+    The explicit `kpoints` and the `call_link_label` are moved to the top level namespace, the remaining
+    `kwargs` (e.g. `max_kpoints_per_batch`) are added as they are.
+    """
+    inputs = AttributeDict(inputs)
+    metadata = dict(inputs.pop('metadata', {}))
+
+    res = AttributeDict(kwargs)
+    res.kpoints = inputs.pop('kpoints')
+    res.base = inputs
+    if 'call_link_label' in metadata:
+        res.metadata = {'call_link_label': metadata['call_link_label']}
+
+    return res
+
+
+class BatchedPwBaseWorkChain(WorkChain):
+    """Workchain to run a PwBaseWorkChain on an explicit list of k-points split in batches running in parallel.
+
+    All the batches use the same inputs (and `parent_folder`), and their `output_band` and `output_parameters`
+    are stitched back together in single output nodes, so that the workchain can be used as a drop-in replacement
+    of a `PwBaseWorkChain` in nscf/bands mode.
+
+    The size of the batches is either specified directly through `max_kpoints_per_batch`, or determined from the
+    `target_walltime` of every job and the estimated `walltime_per_kpoint`.
+    """
+
+    @classmethod
+    def define(cls, spec):
+        """Define the process specification."""
+        # yapf: disable
+        super().define(spec)
+        spec.expose_inputs(PwBaseWorkChain, namespace='base',
+            exclude=('kpoints', 'kpoints_distance', 'kpoints_force_parity'),
+            namespace_options={'help': 'Inputs for the `PwBaseWorkChain` of every batch.'})
+        spec.input('kpoints', valid_type=orm.KpointsData, validator=validate_kpoints,
+            help='Explicit kpoints to split in batches.')
+        spec.input('max_kpoints_per_batch', valid_type=orm.Int, required=False,
+            help='Maximum number of k-points for every batch.')
+        spec.input('target_walltime', valid_type=orm.Float, required=False,
+            help='Target wall time in seconds for every batch. Requires `walltime_per_kpoint`.')
+        spec.input('walltime_per_kpoint', valid_type=orm.Float, required=False,
+            help='Estimated wall time in seconds spent for every k-point.')
+        spec.inputs.validator = validate_inputs
+        spec.outline(
+            cls.split_kpoints,
+            cls.run_batches,
+            cls.inspect_batches,
+            cls.results,
+        )
+        spec.exit_code(401, 'ERROR_SUB_PROCESS_FAILED_BATCH',
+            message='One of the batch PwBaseWorkChain sub processes failed')
+
+        spec.output('output_band', valid_type=orm.BandsData,
+            help='The band structure on all the k-points.')
+        spec.output('output_parameters', valid_type=orm.Dict,
+            help='The output parameters of the first batch, with the number of k-points and wall time summed up.')
+        spec.output_namespace('remote_folders', valid_type=orm.RemoteData, dynamic=True,
+            help='The remote folders of every batch.')
+        # yapf: enable
+
+    def split_kpoints(self):
+        """Split the input k-points in batches."""
+        if 'max_kpoints_per_batch' in self.inputs:
+            max_kpoints = self.inputs.max_kpoints_per_batch
+        else:
+            max_kpoints = orm.Int(max(int(self.inputs.target_walltime.value / self.inputs.walltime_per_kpoint.value), 1))
+
+        self.ctx.batches = kpt_split(self.inputs.kpoints, max_kpoints)
+        self.report('split {} k-points in {} batches of at most {} k-points'.format(
+            sum(len(b.get_kpoints()) for b in self.ctx.batches.values()), len(self.ctx.batches), max_kpoints.value))
+
+    def run_batches(self):
+        """Run a PwBaseWorkChain for every batch of k-points."""
+        running = {}
+        for label, kpoints in sorted(self.ctx.batches.items()):
+            inputs = AttributeDict(self.exposed_inputs(PwBaseWorkChain, namespace='base'))
+            inputs.metadata.call_link_label = label
+            inputs.kpoints = kpoints
+
+            inputs = prepare_process_inputs(PwBaseWorkChain, inputs)
+            node = self.submit(PwBaseWorkChain, **inputs)
+
+            self.report('launching PwBaseWorkChain<{}> for {}'.format(node.pk, label))
+            running['workchain_{}'.format(label)] = node
+
+        return ToContext(**running)
+
+    def inspect_batches(self):
+        """Verify that the PwBaseWorkChain of every batch finished successfully."""
+        for label in sorted(self.ctx.batches):
+            workchain = self.ctx['workchain_{}'.format(label)]
+            if not workchain.is_finished_ok:
+                self.report('{} PwBaseWorkChain failed with exit status {}'.format(label, workchain.exit_status))
+                return self.exit_codes.ERROR_SUB_PROCESS_FAILED_BATCH
+
+    def results(self):
+        """Stitch together the outputs of the batches."""
+        bands  = {}
+        params = {}
+        remote = {}
+        for label, kpoints in self.ctx.batches.items():
+            workchain = self.ctx['workchain_{}'.format(label)]
+            bands['bands_{}'.format(label)]   = workchain.outputs.output_band
+            bands['kpoints_{}'.format(label)] = kpoints
+            params[label] = workchain.outputs.output_parameters
+            remote[label] = workchain.outputs.remote_folder
+
+        self.out('output_band', bands_merge(**bands))
+        self.out('output_parameters', merge_output_parameters(**params))
+        self.out('remote_folders', remote)
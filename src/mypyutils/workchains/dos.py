@@ -8,11 +8,29 @@ from aiida.engine import WorkChain, ToContext, if_
 from aiida_quantumespresso.utils.mapping import prepare_process_inputs
 from aiida_quantumespresso.calculations.functions.create_kpoints_from_distance import create_kpoints_from_distance
 
-from .kpoint_grids import kpt_crop, mergeXyData
+from .kpoint_grids import kpt_crop, kpt_diff, bands_merge, bands_to_dos, mergeMultipleXyData
+from .batched_pw import BatchedPwBaseWorkChain, get_batched_inputs
 
 PwBaseWorkChain = WorkflowFactory('quantumespresso.pw.base')
 DosCalc = CalculationFactory('quantumespresso.dos')
 
+def has_dos_degauss(parameters):
+    """Return True if `degauss` is set in the `DOS` namelist of the DosCalculation `parameters`."""
+    if parameters is None:
+        return False
+    dos_param = {k.upper(): v for k,v in parameters.get_dict().items()}.get('DOS', {})
+    return 'degauss' in (k.lower() for k in dos_param)
+
+def has_explicit_kpoints(kpoints):
+    """Return True if `kpoints` is a KpointsData with an explicit list of k-points (and not a mesh)."""
+    if kpoints is None:
+        return False
+    try:
+        kpoints.get_kpoints()
+    except AttributeError:
+        return False
+    return True
+
 class DosWorkChain(WorkChain):
     """Workchain to compute a DOS for a given structure using Quantum ESPRESSO pw.x. """
 
@@ -40,6 +58,10 @@ class DosWorkChain(WorkChain):
         #          'be generated automatically by a calculation function based on the input structure.')
         spec.input('nbands_factor', valid_type=orm.Float, default=lambda: orm.Float(1.5),
             help='The number of bands for the BANDS calculation is that used for the SCF multiplied by this factor.')
+        spec.input('nscf_batch_size', valid_type=orm.Int, required=False,
+            help='If specified, split the NSCF k-points in parallel batches of at most this size. Requires an explicit '
+                 'list of `nscf.kpoints`. The DOS is then computed from the eigenvalues and requires '
+                 '`dos.parameters.DOS.degauss`.')
         spec.input('clean_workdir', valid_type=orm.Bool, default=lambda: orm.Bool(False),
             help='If `True`, work directories of all called calculation will be cleaned at the end of execution.')
 
@@ -65,16 +87,20 @@ class DosWorkChain(WorkChain):
             message='The scf PwBasexWorkChain sub process failed')
         spec.exit_code(403, 'ERROR_SUB_PROCESS_FAILED_NSCF',
             message='The bands PwBasexWorkChain sub process failed')
+        spec.exit_code(204, 'ERROR_INVALID_INPUT_BATCH',
+            message='`nscf_batch_size` requires `degauss` to be set in `dos.parameters.DOS`.')
+        spec.exit_code(205, 'ERROR_INVALID_INPUT_BATCH_MESH',
+            message='`nscf_batch_size` requires an explicit list of `nscf.kpoints`, not a mesh or `nscf.kpoints_distance`.')
         spec.exit_code(404, 'ERROR_SUB_PROCESS_FAILED_DOS',
             message='The dos DosCalculation sub process failed')
 
         spec.output('scf_remote_folder', valid_type=orm.RemoteData)
-        spec.output('nscf_remote_folder', valid_type=orm.RemoteData)
+        spec.output('nscf_remote_folder', valid_type=orm.RemoteData, required=False)
         spec.output('scf_parameters', valid_type=orm.Dict,
             help='The output parameters of the SCF `PwBaseWorkChain`.')
         spec.output('nscf_parameters', valid_type=orm.Dict,
             help='The output parameters of the NSCF `PwBaseWorkChain`.')
-        spec.output('dos_parameters', valid_type=orm.Dict,
+        spec.output('dos_parameters', valid_type=orm.Dict, required=False,
             help='The output parameters of the DOS calculation.')
         spec.output('output_dos', valid_type=orm.XyData)
 
@@ -83,8 +109,17 @@ class DosWorkChain(WorkChain):
         """Define the current structure in the context to be the input structure."""
         self.ctx.current_structure = self.inputs.structure
         self.ctx.current_number_of_bands = None
+        self.ctx.nscf_batched = 'nscf_batch_size' in self.inputs
         # self.ctx.bands_kpoints = self.inputs.get('bands_kpoints', None)
 
+        if self.ctx.nscf_batched and not has_dos_degauss(self.inputs.dos.get('parameters', None)):
+            self.report('`dos.parameters.DOS.degauss` is required to compute the DOS from the eigenvalues.')
+            return self.exit_codes.ERROR_INVALID_INPUT_BATCH
+
+        if self.ctx.nscf_batched and not has_explicit_kpoints(self.inputs.nscf.get('kpoints', None)):
+            self.report('`nscf_batch_size` requires an explicit list of `nscf.kpoints`: a mesh is not reduced by symmetry.')
+            return self.exit_codes.ERROR_INVALID_INPUT_BATCH_MESH
+
     def should_do_scf(self):
         if 'parent_folder' in self.inputs:
             remote = self.inputs.parent_folder
@@ -171,9 +206,13 @@ class DosWorkChain(WorkChain):
             inputs.pw.parameters['SYSTEM'].setdefault('nbnd', self.ctx.current_number_of_bands)
 
         inputs = prepare_process_inputs(PwBaseWorkChain, inputs)
-        running = self.submit(PwBaseWorkChain, **inputs)
+        if self.ctx.nscf_batched:
+            inputs = get_batched_inputs(inputs, max_kpoints_per_batch=self.inputs.nscf_batch_size)
+            running = self.submit(BatchedPwBaseWorkChain, **inputs)
+        else:
+            running = self.submit(PwBaseWorkChain, **inputs)
 
-        self.report('launching PwBaseWorkChain<{}> in {} mode'.format(running.pk, 'nscf'))
+        self.report('launching {}<{}> in {} mode'.format(running.process_label, running.pk, 'nscf'))
 
         return ToContext(workchain_nscf=running)
 
@@ -186,14 +225,22 @@ class DosWorkChain(WorkChain):
             self.report('scf PwBaseWorkChain failed with exit status {}'.format(workchain.exit_status))
             return self.exit_codes.ERROR_SUB_PROCESS_FAILED_NSCF
 
-        self.ctx.current_folder = workchain.outputs.remote_folder
         self.ctx.current_number_of_bands = workchain.outputs.output_parameters.get_attribute('number_of_bands')
-
-        self.out('nscf_remote_folder', workchain.outputs.remote_folder)
         self.out('nscf_parameters', workchain.outputs.output_parameters)
 
+        if not self.ctx.nscf_batched:
+            self.ctx.current_folder = workchain.outputs.remote_folder
+            self.out('nscf_remote_folder', workchain.outputs.remote_folder)
+
     def run_dos(self):
         """Run the PwBaseWorkChain in bands mode along the path of high-symmetry determined by seekpath."""
+        if self.ctx.nscf_batched:
+            # The eigenvalues are spread over multiple remote folders: dos.x can not be used.
+            scf_parameters = self.ctx.workchain_scf.outputs.output_parameters
+            bands = self.ctx.workchain_nscf.outputs.output_band
+            self.ctx.output_dos = bands_to_dos(bands, self.inputs.dos.parameters, scf_parameters)
+            return
+
         inputs = AttributeDict(self.exposed_inputs(DosCalc, namespace='dos'))
         inputs.metadata.call_link_label = 'dos'
         inputs.parent_folder = self.ctx.current_folder
@@ -207,6 +254,10 @@ class DosWorkChain(WorkChain):
 
     def inspect_dos(self):
         """Verify that the PwBaseWorkChain for the bands run finished successfully."""
+        if self.ctx.nscf_batched:
+            self.out('output_dos', self.ctx.output_dos)
+            return
+
         workchain = self.ctx.workchain_dos
 
         if not workchain.is_finished_ok:
@@ -276,14 +327,24 @@ class DosWorkChain_cropped(WorkChain):
             help='The number of bands for the BANDS calculation is that used for the SCF multiplied by this factor.')
         spec.input('nbands_factor_crop', valid_type=orm.Float, default=lambda: orm.Float(1.5),
             help='The number of bands for the BANDS calculation is that used for the SCF multiplied by this factor.')
+        spec.input('nscf_crop_batch_size', valid_type=orm.Int, required=False,
+            help='If specified, split the NSCF k-points of the CROP grid in parallel batches of at most this size. '
+                 'The DOS of the CROP grid is then computed from the eigenvalues and requires '
+                 '`dos_crop.parameters.DOS.degauss`.')
 
         spec.input('clean_workdir', valid_type=orm.Bool, default=lambda: orm.Bool(False),
             help='If `True`, work directories of all called calculation will be cleaned at the end of execution.')
 
         spec.input('crop_radii', valid_type=orm.ArrayData)
         spec.input('crop_centers', valid_type=orm.ArrayData)
+        spec.input('crop_periodic', valid_type=orm.Bool, default=lambda: orm.Bool(False),
+            help='If `True`, crop the k-points using the minimum image distance from the centers.')
         spec.input('override_dos', valid_type=orm.XyData)
         spec.input('override_dos_weight', valid_type=orm.Float, required=False)
+        spec.input('previous_bands_crop', valid_type=orm.BandsData, required=False,
+            help='The `bands_crop` output of a previous run on the same SCF. If specified, the NSCF calculation is '
+                 'run only on the new k-points of the CROP grid, and the DOS of the CROP grid is computed from the '
+                 'eigenvalues, reusing the ones of `previous_bands_crop`. Requires `dos_crop.parameters.DOS.degauss`.')
 
         spec.outline(
             cls.setup,
@@ -293,16 +354,13 @@ class DosWorkChain_cropped(WorkChain):
                 cls.inspect_scf,
                 ),
             cls.prepare_kgrids,
-            if_(cls.should_do_full)(
-                cls.run_nscf_full,
-                cls.inspect_nscf_full,
-                cls.run_dos_full,
-                cls.inspect_dos_full
+            if_(cls.should_do_incremental)(
+                cls.diff_kgrids,
                 ),
-            cls.run_nscf_crop,
-            cls.inspect_nscf_crop,
-            cls.run_dos_crop,
-            cls.inspect_dos_crop,
+            cls.run_nscf,
+            cls.inspect_nscf,
+            cls.run_dos,
+            cls.inspect_dos,
             cls.merge_results,
             cls.results,
         )
@@ -312,6 +370,8 @@ class DosWorkChain_cropped(WorkChain):
             message='Cannot specify both `bands_kpoints` and `bands_kpoints_distance`.')
         spec.exit_code(203, 'ERROR_INVALID_INPUT_CROP',
             message='Cannot specify both `bands_kpoints` and `bands_kpoints_distance`.')
+        spec.exit_code(204, 'ERROR_INVALID_INPUT_INCREMENTAL',
+            message='`previous_bands_crop` and `nscf_crop_batch_size` require `degauss` in `dos_crop.parameters.DOS`.')
         spec.exit_code(401, 'ERROR_SUB_PROCESS_FAILED_RELAX',
             message='The PwRelaxWorkChain sub process failed')
         spec.exit_code(402, 'ERROR_SUB_PROCESS_FAILED_SCF',
@@ -323,30 +383,49 @@ class DosWorkChain_cropped(WorkChain):
 
         spec.output('scf_remote_folder', valid_type=orm.RemoteData)
         spec.output('nscf_full_remote_folder', valid_type=orm.RemoteData, required=False)
-        spec.output('nscf_crop_remote_folder', valid_type=orm.RemoteData)
+        spec.output('nscf_crop_remote_folder', valid_type=orm.RemoteData, required=False)
         spec.output('scf_parameters', valid_type=orm.Dict,
             help='The output parameters of the SCF `PwBaseWorkChain`.')
         spec.output('nscf_full_parameters', valid_type=orm.Dict,
             help='The output parameters of the NSCF full `PwBaseWorkChain`.', required=False)
-        spec.output('nscf_crop_parameters', valid_type=orm.Dict,
+        spec.output('nscf_crop_parameters', valid_type=orm.Dict, required=False,
             help='The output parameters of the NSCF crop `PwBaseWorkChain`.')
         spec.output('dos_full_parameters', valid_type=orm.Dict, required=False,
             help='The output parameters of the DOS full calculation.')
         spec.output('output_dos_full', valid_type=orm.XyData, required=False)
-        spec.output('dos_crop_parameters', valid_type=orm.Dict,
+        spec.output('dos_crop_parameters', valid_type=orm.Dict, required=False,
             help='The output parameters of the DOS crop calculation.')
         spec.output('output_dos_crop', valid_type=orm.XyData)
 
         spec.output('kpoints_full', valid_type=orm.KpointsData)
         spec.output('kpoints_crop', valid_type=orm.KpointsData)
+        spec.output('bands_crop', valid_type=orm.BandsData,
+            help='The eigenvalues on the CROP grid, to be used as `previous_bands_crop` by following runs.')
 
         spec.output('output_dos_merged', valid_type=orm.XyData)
 
+    @classmethod
+    def get_builder_from_previous(cls, previous):
+        """Return a builder to refine a previous `DosWorkChain_cropped` run incrementally.
+
+        The SCF of `previous` is reused and the NSCF calculation is run only on the k-points of the CROP grid
+        that are not already part of its `bands_crop` output. Change `crop_centers`/`crop_radii` before submitting.
+        """
+        builder = previous.get_builder_restart()
+        if 'parent_folder' in previous.inputs:
+            builder.parent_folder = previous.inputs.parent_folder
+        else:
+            builder.parent_folder = previous.outputs.scf_remote_folder
+        builder.previous_bands_crop = previous.outputs.bands_crop
+
+        return builder
 
     def setup(self):
         """Define the current structure in the context to be the input structure."""
         self.ctx.current_structure = self.inputs.structure
         self.ctx.current_number_of_bands = None
+        self.ctx.nscf_crop_batched = 'nscf_crop_batch_size' in self.inputs
+        self.ctx.dos_crop_from_bands = self.should_do_incremental() or self.ctx.nscf_crop_batched
         # self.ctx.bands_kpoints = self.inputs.get('bands_kpoints', None)
 
     def validate_crop_inputs(self):
@@ -358,6 +437,10 @@ class DosWorkChain_cropped(WorkChain):
             self.report('`crop_centers` and `crop_radii` should be contain the same amount of elements.')
             return self.exit_codes.ERROR_INVALID_INPUT_CROP
 
+        if self.ctx.dos_crop_from_bands and not has_dos_degauss(self.inputs.dos_crop.get('parameters', None)):
+            self.report('`dos_crop.parameters.DOS.degauss` is required to compute the DOS from the eigenvalues.')
+            return self.exit_codes.ERROR_INVALID_INPUT_INCREMENTAL
+
     def should_do_scf(self):
         if 'parent_folder' in self.inputs:
             remote = self.inputs.parent_folder
@@ -418,8 +501,10 @@ class DosWorkChain_cropped(WorkChain):
 
         nk_full = len(k_full.get_kpoints_mesh(print_list=True))
         nk_crop = len(k_crop.get_kpoints_mesh(print_list=True))
-        self.ctx.kpoint_full = kpt_crop(k_full, self.inputs.crop_centers, self.inputs.crop_radii, orm.Bool(True))
-        self.ctx.kpoint_crop = kpt_crop(k_crop, self.inputs.crop_centers, self.inputs.crop_radii, orm.Bool(False))
+        self.ctx.kpoint_full = kpt_crop(
+            k_full, self.inputs.crop_centers, self.inputs.crop_radii, orm.Bool(True), self.inputs.crop_periodic)
+        self.ctx.kpoint_crop = kpt_crop(
+            k_crop, self.inputs.crop_centers, self.inputs.crop_radii, orm.Bool(False), self.inputs.crop_periodic)
         self.ctx.kpoint_full_weight = self.ctx.kpoint_full
         self.ctx.kpoint_crop_weight = self.ctx.kpoint_crop
         nka_full = len(self.ctx.kpoint_full.get_kpoints())
@@ -429,9 +514,28 @@ class DosWorkChain_cropped(WorkChain):
         self.report('{}/{} k-points anti-cropped from FULL grid. tot_weight={}'.format(nka_full, nk_full, nka_full_weight))
         self.report('{}/{} k-points cropped from CROP grid. tot_weight={}'.format(nka_crop, nk_crop, nka_crop_weight))
 
+        self.ctx.kpoint_crop_nscf  = self.ctx.kpoint_crop
+        self.ctx.bands_crop_reused = None
+
         self.out('kpoints_full', self.ctx.kpoint_full)
         self.out('kpoints_crop', self.ctx.kpoint_crop)
 
+    def should_do_incremental(self):
+        return 'previous_bands_crop' in self.inputs
+
+    def diff_kgrids(self):
+        """Split the CROP grid in the k-points already computed in `previous_bands_crop` and the new ones."""
+        res = kpt_diff(self.ctx.kpoint_crop, self.inputs.previous_bands_crop)
+        self.ctx.bands_crop_reused = res.get('bands_reused', None)
+        self.ctx.kpoint_crop_nscf  = res.get('kpoints_new', None)
+
+        nk_crop = len(self.ctx.kpoint_crop.get_kpoints())
+        nk_new  = 0
+        if self.ctx.kpoint_crop_nscf is not None:
+            nk_new = len(self.ctx.kpoint_crop_nscf.get_kpoints())
+        self.report('{}/{} k-points of the CROP grid reused from BandsData<{}>'.format(
+            nk_crop - nk_new, nk_crop, self.inputs.previous_bands_crop.pk))
+
     def should_do_full(self):
         if 'override_dos' in self.inputs:
             self.report('overriding FULL-CROP grid. Using DOS <{}> instead.'.format(self.inputs.override_dos.pk))
@@ -441,8 +545,50 @@ class DosWorkChain_cropped(WorkChain):
             return False
         return True
 
-    def run_nscf_full(self):
-        """Run the PwBaseWorkChain in nscf mode along the path of high-symmetry determined by seekpath."""
+    def run_nscf(self):
+        """Launch the NSCF calculations for the FULL - CROP and CROP grids concurrently on the SCF folder."""
+        self.ctx.do_full = self.should_do_full()
+
+        running = {}
+        if self.ctx.do_full:
+            running['workchain_nscf_full'] = self.submit_nscf_full()
+        if self.should_run_nscf_crop():
+            running['workchain_nscf_crop'] = self.submit_nscf_crop()
+
+        return ToContext(**running)
+
+    def inspect_nscf(self):
+        """Verify that the NSCF calculations of both grids finished successfully."""
+        if self.ctx.do_full:
+            exit_code = self.inspect_nscf_full()
+            if exit_code:
+                return exit_code
+        if self.ctx.kpoint_crop_nscf is not None:
+            return self.inspect_nscf_crop()
+
+    def run_dos(self):
+        """Launch the DOS calculations for the FULL - CROP and CROP grids concurrently."""
+        running = {}
+        if self.ctx.do_full:
+            running['workchain_dos_full'] = self.submit_dos_full()
+        if self.ctx.dos_crop_from_bands:
+            self.compute_dos_crop()
+        else:
+            running['workchain_dos_crop'] = self.submit_dos_crop()
+
+        return ToContext(**running)
+
+    def inspect_dos(self):
+        """Verify that the DOS calculations of both grids finished successfully."""
+        if self.ctx.do_full:
+            exit_code = self.inspect_dos_full()
+            if exit_code:
+                return exit_code
+        if not self.ctx.dos_crop_from_bands:
+            return self.inspect_dos_crop()
+
+    def submit_nscf_full(self):
+        """Submit the PwBaseWorkChain in nscf mode on the FULL - CROP grid."""
         inputs = AttributeDict(self.exposed_inputs(PwBaseWorkChain, namespace='nscf_full'))
         inputs.metadata.call_link_label = 'nscf_full'
         # inputs.pw.metadata.options.max_wallclock_seconds *= 4
@@ -489,7 +635,7 @@ class DosWorkChain_cropped(WorkChain):
 
         self.report('launching PwBaseWorkChain<{}> in {} mode for FULL - CROP grid'.format(running.pk, 'nscf'))
 
-        return ToContext(workchain_nscf_full=running)
+        return running
 
 
     def inspect_nscf_full(self):
@@ -500,24 +646,23 @@ class DosWorkChain_cropped(WorkChain):
             self.report('scf PwBaseWorkChain failed with exit status {}'.format(workchain.exit_status))
             return self.exit_codes.ERROR_SUB_PROCESS_FAILED_NSCF
 
-        self.ctx.current_folder = workchain.outputs.remote_folder
-        self.ctx.current_number_of_bands = workchain.outputs.output_parameters.get_attribute('number_of_bands')
+        self.ctx.nscf_full_folder = workchain.outputs.remote_folder
 
-        self.out('nscf_full_remote_folder_', workchain.outputs.remote_folder)
+        self.out('nscf_full_remote_folder', workchain.outputs.remote_folder)
         self.out('nscf_full_parameters', workchain.outputs.output_parameters)
 
-    def run_dos_full(self):
-        """Run the PwBaseWorkChain in bands mode along the path of high-symmetry determined by seekpath."""
+    def submit_dos_full(self):
+        """Submit the DosCalculation on the NSCF folder of the FULL - CROP grid."""
         inputs = AttributeDict(self.exposed_inputs(DosCalc, namespace='dos_full'))
         inputs.metadata.call_link_label = 'dos_full'
-        inputs.parent_folder = self.ctx.current_folder
+        inputs.parent_folder = self.ctx.nscf_full_folder
 
         inputs = prepare_process_inputs(DosCalc, inputs)
         running = self.submit(DosCalc, **inputs)
 
         self.report('launching DosCalculation<{}> in {} mode for the FULL - CROP grid'.format(running.pk, 'dos'))
 
-        return ToContext(workchain_dos_full=running)
+        return running
 
     def inspect_dos_full(self):
         """Verify that the PwBaseWorkChain for the bands run finished successfully."""
@@ -532,10 +677,14 @@ class DosWorkChain_cropped(WorkChain):
         self.out('dos_full_parameters', workchain.outputs.output_parameters)
         self.out('output_dos_full', workchain.outputs.output_dos)
 
+    def should_run_nscf_crop(self):
+        if self.ctx.kpoint_crop_nscf is None:
+            self.report('no new k-points in the CROP grid, skipping NSCF calculation.')
+            return False
+        return True
 
-
-    def run_nscf_crop(self):
-        """Run the PwBaseWorkChain in nscf mode along the path of high-symmetry determined by seekpath."""
+    def submit_nscf_crop(self):
+        """Submit the PwBaseWorkChain in nscf mode on the CROP grid."""
         inputs = AttributeDict(self.exposed_inputs(PwBaseWorkChain, namespace='nscf_crop'))
         inputs.metadata.call_link_label = 'nscf_crop'
         # inputs.pw.metadata.options.max_wallclock_seconds *= 4
@@ -551,7 +700,7 @@ class DosWorkChain_cropped(WorkChain):
         inputs.pw.parameters['CONTROL']['calculation'] = 'nscf'
 
         inputs.pop('kpoints_distance', None)
-        inputs.kpoints = self.ctx.kpoint_crop
+        inputs.kpoints = self.ctx.kpoint_crop_nscf
 
         # Only set the following parameters if not directly explicitly defined in the inputs
         # inputs.pw.parameters['ELECTRONS'].setdefault('diagonalization', 'cg')
@@ -578,11 +727,15 @@ class DosWorkChain_cropped(WorkChain):
             inputs.pw.parameters['SYSTEM'].setdefault('nbnd', self.ctx.current_number_of_bands)
 
         inputs = prepare_process_inputs(PwBaseWorkChain, inputs)
-        running = self.submit(PwBaseWorkChain, **inputs)
+        if self.ctx.nscf_crop_batched:
+            inputs = get_batched_inputs(inputs, max_kpoints_per_batch=self.inputs.nscf_crop_batch_size)
+            running = self.submit(BatchedPwBaseWorkChain, **inputs)
+        else:
+            running = self.submit(PwBaseWorkChain, **inputs)
 
-        self.report('launching PwBaseWorkChain<{}> in {} mode for CROP grid'.format(running.pk, 'nscf'))
+        self.report('launching {}<{}> in {} mode for CROP grid'.format(running.process_label, running.pk, 'nscf'))
 
-        return ToContext(workchain_nscf_crop=running)
+        return running
 
 
     def inspect_nscf_crop(self):
@@ -593,24 +746,28 @@ class DosWorkChain_cropped(WorkChain):
             self.report('scf PwBaseWorkChain failed with exit status {}'.format(workchain.exit_status))
             return self.exit_codes.ERROR_SUB_PROCESS_FAILED_NSCF
 
-        self.ctx.current_folder = workchain.outputs.remote_folder
-        self.ctx.current_number_of_bands = workchain.outputs.output_parameters.get_attribute('number_of_bands')
-
-        self.out('nscf_crop_remote_folder', workchain.outputs.remote_folder)
         self.out('nscf_crop_parameters', workchain.outputs.output_parameters)
 
-    def run_dos_crop(self):
-        """Run the PwBaseWorkChain in bands mode along the path of high-symmetry determined by seekpath."""
+        if not self.ctx.nscf_crop_batched:
+            self.ctx.nscf_crop_folder = workchain.outputs.remote_folder
+            self.out('nscf_crop_remote_folder', workchain.outputs.remote_folder)
+
+        if not self.ctx.dos_crop_from_bands:
+            bands = bands_merge(bands_crop=workchain.outputs.output_band, kpoints_crop=self.ctx.kpoint_crop)
+            self.out('bands_crop', bands)
+
+    def submit_dos_crop(self):
+        """Submit the DosCalculation on the NSCF folder of the CROP grid."""
         inputs = AttributeDict(self.exposed_inputs(DosCalc, namespace='dos_crop'))
         inputs.metadata.call_link_label = 'dos_crop'
-        inputs.parent_folder = self.ctx.current_folder
+        inputs.parent_folder = self.ctx.nscf_crop_folder
 
         inputs = prepare_process_inputs(DosCalc, inputs)
         running = self.submit(DosCalc, **inputs)
 
         self.report('launching DosCalculation<{}> in {} mode fro CROP grid'.format(running.pk, 'dos'))
 
-        return ToContext(workchain_dos_crop=running)
+        return running
 
     def inspect_dos_crop(self):
         """Verify that the PwBaseWorkChain for the bands run finished successfully."""
@@ -625,9 +782,28 @@ class DosWorkChain_cropped(WorkChain):
         self.out('dos_crop_parameters', workchain.outputs.output_parameters)
         self.out('output_dos_crop', workchain.outputs.output_dos)
 
+    def compute_dos_crop(self):
+        """Compute the DOS of the CROP grid from the reused and the newly computed eigenvalues."""
+        inputs = {}
+        if self.ctx.bands_crop_reused is not None:
+            inputs['bands_reused'] = self.ctx.bands_crop_reused
+        if self.ctx.kpoint_crop_nscf is not None:
+            inputs['bands_new']   = self.ctx.workchain_nscf_crop.outputs.output_band
+            inputs['kpoints_new'] = self.ctx.kpoint_crop_nscf
+        bands = bands_merge(**inputs)
+
+        scf_parameters = self.ctx.workchain_scf.outputs.output_parameters
+        self.ctx.dos_crop = bands_to_dos(bands, self.inputs.dos_crop.parameters, scf_parameters)
+
+        self.out('bands_crop', bands)
+        self.out('output_dos_crop', self.ctx.dos_crop)
+
     def merge_results(self):
         """Merge dos from the 2 grids."""
-        res = mergeXyData(self.ctx.dos_full, self.ctx.dos_crop, self.ctx.kpoint_full_weight, self.ctx.kpoint_crop_weight)
+        res = mergeMultipleXyData(
+            data_full=self.ctx.dos_full, weight_full=self.ctx.kpoint_full_weight,
+            data_crop=self.ctx.dos_crop, weight_crop=self.ctx.kpoint_crop_weight,
+            )
         self.out('output_dos_merged', res)
 
     def results(self):
@@ -1,7 +1,5 @@
 import numpy as np
-import scipy
-import scipy.interpolate
-# from scipy.spatial import KDTree
+from scipy.spatial import cKDTree
 from aiida import orm
 # from aiida.common import AttributeDict
 # from aiida.plugins import WorkflowFactory, CalculationFactory
@@ -9,17 +7,22 @@ from aiida.engine import calcfunction
 
 # from aiida_quantumespresso.utils.mapping import prepare_process_inputs
 
-def recipr_base(base):
-	return np.linalg.inv(base).T * 2 * np.pi
+from ..kspace import recipr_base, PeriodicKTree
+
+KPT_CROP_CHUNK_SIZE = 2**16
+RY_TO_EV = 13.605693122994
 
 def _kpt_crop(
 	kpt_coord, recipr=np.diag([1,1,1]), kpt_weight=None,
 	centers=[], radii=np.inf,
-	anticrop=False,
+	anticrop=False, periodic=False,
+	chunk_size=KPT_CROP_CHUNK_SIZE,
 	verbose=False
 	):
 	"""
 	Crop the k-points in a sphere of radius 'radius' with center 'center':
+	All the centers are evaluated in one batched pass over blocks of 'chunk_size' k-points,
+	building a boolean mask of the selected points.
 	Params:
 	 - kpt_coord: (#nkpt,3) shaped array of kpoints in cart/cryst coordinates.
 	 - recipr: transformation matrix for the kpt coordinates to cartesian.
@@ -31,6 +34,12 @@ def _kpt_crop(
 	 - centers: list of tuples of 3 floats containing the coordinate of the center
 	           of the crop sphere. default = []
 	 - radius: Radius of the crop sphere. Defaulr = np.inf
+	 - anticrop: If True select the k-points outside of all the spheres instead. Default = False
+	 - periodic: If True use the minimum image distance between k-points and centers, so that
+	           spheres crossing the zone boundary are accounted for. Requires 'recipr' to be the
+	           reciprocal lattice. Default = False
+	 - chunk_size: Number of k-points compared against all the centers at once. The memory
+	           used scales as chunk_size * #centers. Default = KPT_CROP_CHUNK_SIZE
 	 - verbose: Print information about the cropping. Default = True
 	"""
 	nc = len(centers)
@@ -42,6 +51,8 @@ def _kpt_crop(
 	for radius in radii:
 		if radius < 0:
 			raise ValueError("Radius must be greather than 0.")
+	if chunk_size < 1:
+		raise ValueError("Chunk size must be greather than 0.")
 
 	kpt_coord  = np.array(kpt_coord)
 	kpt_cart   = kpt_coord.dot(recipr)
@@ -53,22 +64,28 @@ def _kpt_crop(
 		kpt_weight = np.array(kpt_weight)
 	kpt_weight /= kpt_weight.sum()
 
-	list_center = np.array(centers).reshape(-1,3)
-	index = set()
-	for center,radius in zip(list_center, radii):
-		norms  = np.linalg.norm(kpt_cart - center, axis=1)
-
-		if not anticrop:
-			w = np.where(norms <= radius)[0]
-			index = index.union(set(w))
-		else:
-			w = np.where(norms > radius)[0]
-			if not index:
-				index = index.union(set(w))
+	list_center = np.array(centers, dtype=float).reshape(-1,3)
+	list_radii  = np.array(radii, dtype=float).reshape(-1)
+
+	mask = np.zeros(n_kpt, dtype=bool)
+	if nc and periodic:
+		tree  = PeriodicKTree(kpt_cart, recipr)
+		query = tree.query_ball_point(list_center, list_radii)
+		mask[np.concatenate(query)] = True
+		if anticrop:
+			mask = ~mask
+	elif nc:
+		for start in range(0, n_kpt, chunk_size):
+			chunk = kpt_cart[start:start+chunk_size]
+			diff  = chunk[:, np.newaxis, :] - list_center[np.newaxis, :, :]
+			norms = np.sqrt((diff * diff).sum(axis=-1))
+
+			if not anticrop:
+				mask[start:start+chunk_size] = (norms <= list_radii).any(axis=1)
 			else:
-				index = index.intersection(set(w))
+				mask[start:start+chunk_size] = (norms > list_radii).all(axis=1)
 
-	index = list(index)
+	index = np.where(mask)[0]
 
 	res_kpt    = kpt_cart[index]
 	res_weight = kpt_weight[index]
@@ -78,7 +95,7 @@ def _kpt_crop(
 	# norm = crop_weight / tot_weight
 
 	if verbose:
-		print(f"# Cropping k-points around {centers} with radius {radius}")
+		print(f"# Cropping k-points around {centers} with radii {radii}")
 		print(f"# Cropped {len(index)} k-points out of {n_kpt}")
 		print(f"# The weight of the selected points is {crop_weight} vs the total weight {tot_weight}")
 		print(f"# Re-normaliing by a factor {tot_weight/crop_weight}")
@@ -89,7 +106,7 @@ def _kpt_crop(
 	return res_kpt, res_weight
 
 @calcfunction
-def kpt_crop(kpoints: orm.KpointsData, centers: orm.ArrayData, radii: orm.ArrayData, anticrop: orm.Bool) -> orm.KpointsData:
+def kpt_crop(kpoints: orm.KpointsData, centers: orm.ArrayData, radii: orm.ArrayData, anticrop: orm.Bool, periodic: orm.Bool = None) -> orm.KpointsData:
 	kpt_cryst = kpoints.get_kpoints_mesh(print_list=True)
 	cell = kpoints.cell
 	recipr = recipr_base(cell)
@@ -98,7 +115,9 @@ def kpt_crop(kpoints: orm.KpointsData, centers: orm.ArrayData, radii: orm.ArrayD
 	centers = centers.dot(recipr)
 	radii   = radii.get_array('radii')
 
-	kpt, wgt = _kpt_crop(kpt_cryst, recipr, centers=centers, radii=radii, anticrop=anticrop.value)
+	periodic = periodic is not None and periodic.value
+
+	kpt, wgt = _kpt_crop(kpt_cryst, recipr, centers=centers, radii=radii, anticrop=anticrop.value, periodic=periodic)
 
 	res = orm.KpointsData()
 	res.set_cell(cell)
@@ -111,73 +130,319 @@ def pw2gwArray_to_XyData(array: orm.ArrayData) -> orm.XyData:
 	res = orm.XyData()
 	return res
 
-@calcfunction
-def mergeXyData(data1, data2, weight1, weight2) -> orm.XyData:
-	if isinstance(weight1, orm.Float):
-		W1 = weight1.value
-	elif isinstance(weight1, orm.KpointsData):
-		W1 = weight1.get_array('weights').sum()
-	else:
-		raise TypeError('`weight1` is of unsupported type {}'.format(type(weight1)))
-	if isinstance(weight2, orm.Float):
-		W2 = weight2.value
-	elif isinstance(weight2, orm.KpointsData):
-		W2 = weight2.get_array('weights').sum()
-	else:
-		raise TypeError('`weight2` is of unsupported type {}'.format(type(weight1)))
-
-	x1 = data1.get_x()
-	x2 = data2.get_x()
+def _get_weight(weight, name='weight'):
+	if isinstance(weight, orm.Float):
+		return weight.value
+	elif isinstance(weight, orm.KpointsData):
+		return weight.get_array('weights').sum()
+	raise TypeError('`{}` is of unsupported type {}'.format(name, type(weight)))
 
-	if x1[0] != x2[0] or x1[2] != x2[2]:
-		raise ValueError('Mismatch in X axis')
-	X1 = x1[1]
-	X2 = x2[1]
+def _interp_batch(x, y, new_x):
+	"""
+	Linearly interpolate all the rows of 'y' sampled on 'x' onto 'new_x' at once.
+	Values outside of the range of 'x' are set to 0.
+	Params:
+	 - x: (#npt) shaped array sorted in ascending order.
+	 - y: (#ny,#npt) shaped array.
+	 - new_x: (#nnew) shaped array.
+	"""
+	idx = np.searchsorted(x, new_x, side='right') - 1
+	idx = np.clip(idx, 0, len(x) - 2)
 
+	x0 = x[idx]
+	x1 = x[idx+1]
+	t  = (new_x - x0) / (x1 - x0)
 
-	y1 = data1.get_y()
-	y2 = data2.get_y()
+	res = y[:, idx] * (1 - t) + y[:, idx+1] * t
+	res[:, (new_x < x[0]) | (new_x > x[-1])] = 0
 
-	x_min = min(X1.min(), X2.min())
-	x_max = max(X1.max(), X2.max())
-	dx = min(X1[1] - X1[0], X2[1] - X2[0])
+	return res
 
+def _merge_xy(datas, weights):
+	"""
+	Sum the Y arrays of multiple XyData, weighted by 'weights', on a common X grid.
+	The arrays are matched by name against the ones of the first XyData.
+	The grid spans all the X ranges with the smallest step among the inputs.
+	"""
+	x_name, _, x_unit = datas[0].get_x()
 	names = []
 	units = []
-	ly1 = []
-	ly2 = []
-	for name, data, unit in y1:
-		for n2, d2, u2 in y2:
-			if n2 == name:
-				if unit != u2:
-					raise ValueError('Mismatch in Y Axis. Units `{}` != `{}` for array `{}`'.format(
-						unit, u2, name))
-				names.append(name)
-				units.append(unit)
-				ly1.append(data)
-				ly2.append(d2)
-				break
-		else:
-			raise ValueError('Mismatch in Y Axis. `{}` array missing from second set'.format(name))
+	for name, _, unit in datas[0].get_y():
+		names.append(name)
+		units.append(unit)
+
+	x_min = np.inf
+	x_max = -np.inf
+	dx    = np.inf
+	for data in datas:
+		name, X, unit = data.get_x()
+		if name != x_name or unit != x_unit:
+			raise ValueError('Mismatch in X axis')
+		x_min = min(x_min, X.min())
+		x_max = max(x_max, X.max())
+		dx    = min(dx, X[1] - X[0])
 
 	resX = np.arange(x_min, x_max, dx)
-	resYdata = []
-	resYnames = []
-	resYunits = []
-	for Y1, Y2, name, unit in zip(ly1, ly2, names, units):
-		newY1 = scipy.interpolate.interp1d(X1, Y1, bounds_error=False, fill_value=0)(resX)
-		newY2 = scipy.interpolate.interp1d(X2, Y2, bounds_error=False, fill_value=0)(resX)
+	resY = np.zeros((len(names), len(resX)))
+	for data, W in zip(datas, weights):
+		arrays = {name: (arr, unit) for name, arr, unit in data.get_y()}
+		Y = []
+		for name, unit in zip(names, units):
+			if not name in arrays:
+				raise ValueError('Mismatch in Y Axis. `{}` array missing from XyData<{}>'.format(name, data.pk))
+			arr, u2 = arrays[name]
+			if unit != u2:
+				raise ValueError('Mismatch in Y Axis. Units `{}` != `{}` for array `{}`'.format(
+					unit, u2, name))
+			Y.append(arr)
+
+		resY += W * _interp_batch(data.get_x()[1], np.array(Y), resX)
 
-		newY = W1 * newY1 + W2 * newY2
+	res = orm.XyData()
 
-		resYdata.append(newY)
-		resYnames.append(name)
-		resYunits.append(unit)
+	res.set_x(resX, x_name, x_unit)
+	res.set_y(list(resY), names, units)
 
-	res = orm.XyData()
+	return res
+
+@calcfunction
+def mergeXyData(data1, data2, weight1, weight2) -> orm.XyData:
+	W1 = _get_weight(weight1, 'weight1')
+	W2 = _get_weight(weight2, 'weight2')
+
+	return _merge_xy([data1, data2], [W1, W2])
+
+@calcfunction
+def mergeMultipleXyData(**kwargs) -> orm.XyData:
+	"""
+	Merge any number of XyData in a single node.
+	Every 'data_<label>' XyData input is paired with a 'weight_<label>' input, either a Float or a
+	KpointsData (in which case the weight is the sum of the k-point weights).
+	"""
+	labels = sorted(k[len('data_'):] for k in kwargs if k.startswith('data_'))
+	if not labels:
+		raise ValueError('No `data_<label>` input given')
+
+	datas   = []
+	weights = []
+	for label in labels:
+		wname = 'weight_{}'.format(label)
+		if not wname in kwargs:
+			raise ValueError('Missing `{}` input for `data_{}`'.format(wname, label))
+		datas.append(kwargs['data_{}'.format(label)])
+		weights.append(_get_weight(kwargs[wname], wname))
+
+	return _merge_xy(datas, weights)
+
+def _get_kpoints_weights(kpoints):
+	kpt = kpoints.get_kpoints(cartesian=True)
+	try:
+		wgt = kpoints.get_array('weights')
+	except (KeyError, AttributeError):
+		wgt = np.ones(len(kpt))
+
+	return kpt, wgt
+
+def _kpt_match(kpt_cart, ref_cart, tol=1E-5):
+	"""
+	Match the k-points 'kpt_cart' against the reference ones 'ref_cart'.
+	Params:
+	 - kpt_cart: (#nkpt,3) shaped array of kpoints in cartesian coordinates.
+	 - ref_cart: (#nref,3) shaped array of kpoints in cartesian coordinates.
+	 - tol: maximum distance for two points to be considered equal. Default = 1E-5
+	Return:
+	 - Indexes of the points of 'kpt_cart' present in 'ref_cart'.
+	 - Indexes of the corresponding points in 'ref_cart'.
+	 - Indexes of the points of 'kpt_cart' missing from 'ref_cart'.
+	"""
+	tree = cKDTree(ref_cart)
+	dist, idx = tree.query(kpt_cart, distance_upper_bound=tol)
+
+	found = np.isfinite(dist)
+	w_found = np.where(found)[0]
+
+	return w_found, idx[w_found], np.where(~found)[0]
+
+@calcfunction
+def kpt_diff(kpoints: orm.KpointsData, bands: orm.BandsData):
+	"""
+	Split 'kpoints' in the points for which the eigenvalues are already available in 'bands'
+	and the ones that still need to be computed.
+	Return:
+	 - bands_reused: BandsData with the eigenvalues from 'bands' on the common points (with the
+	           coordinates and weights taken from 'kpoints'). Missing if there are no common points.
+	 - kpoints_new: KpointsData with the points missing from 'bands'. Missing if there are none.
+	"""
+	cell = kpoints.cell
+	kpt, wgt = _get_kpoints_weights(kpoints)
+	w_found, w_ref, w_new = _kpt_match(kpt, bands.get_kpoints(cartesian=True))
+
+	res = {}
+	if len(w_found):
+		reused = orm.BandsData()
+		reused.set_cell(cell)
+		reused.set_kpoints(kpt[w_found], cartesian=True, weights=wgt[w_found])
+		reused.set_bands(bands.get_bands()[..., w_ref, :], units=bands.units)
+		res['bands_reused'] = reused
+	if len(w_new):
+		new = orm.KpointsData()
+		new.set_cell(cell)
+		new.set_kpoints(kpt[w_new], cartesian=True, weights=wgt[w_new])
+		res['kpoints_new'] = new
+
+	return res
+
+@calcfunction
+def bands_merge(**kwargs) -> orm.BandsData:
+	"""
+	Concatenate the k-points and eigenvalues of multiple BandsData.
+	Every 'bands_<label>' input can be paired with a 'kpoints_<label>' KpointsData, in which case the
+	coordinates, weights and labels of the k-points are taken from it instead of from the BandsData.
+	If the number of bands differs, only the lowest bands common to all the inputs are kept.
+	"""
+	labels = sorted(k[len('bands_'):] for k in kwargs if k.startswith('bands_'))
+	if not labels:
+		raise ValueError('No `bands_<label>` input given')
+
+	cell  = None
+	units = None
+	kpts  = []
+	wgts  = []
+	bands = []
+	kpt_labels = []
+	for label in labels:
+		data = kwargs['bands_{}'.format(label)]
+		src  = kwargs.get('kpoints_{}'.format(label), data)
+		kpt, wgt = _get_kpoints_weights(src)
+		eig = data.get_bands()
+		if eig.shape[-2] != len(kpt):
+			raise ValueError('Mismatch between the number of k-points and eigenvalues for `{}`'.format(label))
+		if cell is None:
+			cell  = data.cell
+			units = data.units
+
+		offset = sum(len(k) for k in kpts)
+		kpt_labels.extend((i + offset, name) for i, name in (src.labels or []))
+
+		kpts.append(kpt)
+		wgts.append(wgt)
+		bands.append(eig)
+
+	nbnd = min(eig.shape[-1] for eig in bands)
+
+	res = orm.BandsData()
+	res.set_cell(cell)
+	res.set_kpoints(np.vstack(kpts), cartesian=True, weights=np.concatenate(wgts))
+	res.set_bands(np.concatenate([eig[..., :nbnd] for eig in bands], axis=-2), units=units)
+	if kpt_labels:
+		res.labels = kpt_labels
+
+	return res
+
+@calcfunction
+def kpt_split(kpoints: orm.KpointsData, max_kpoints: orm.Int):
+	"""
+	Split 'kpoints' in the minimum number of balanced batches of at most 'max_kpoints' points.
+	'kpoints' must be an explicit list: a mesh is not expanded, as it would not be reduced by symmetry.
+	The batches are returned, in order, as 'batch_<n>' KpointsData keeping the weights and labels.
+	"""
+	if max_kpoints.value < 1:
+		raise ValueError('`max_kpoints` must be greather than 0.')
+	try:
+		kpt = kpoints.get_kpoints()
+	except AttributeError:
+		raise ValueError('Cannot split a k-points mesh, an explicit list of k-points is required.')
+	try:
+		wgt = kpoints.get_array('weights')
+	except (KeyError, AttributeError):
+		wgt = None
+	labels = kpoints.labels or []
+
+	n_kpt = len(kpt)
+	if not n_kpt:
+		raise ValueError('Cannot split an empty list of k-points.')
+	n_batch = -(-n_kpt // max_kpoints.value)
+
+	res = {}
+	for n, index in enumerate(np.array_split(np.arange(n_kpt), n_batch)):
+		start = index[0]
+		end   = index[-1] + 1
+
+		batch = orm.KpointsData()
+		batch.set_cell(kpoints.cell)
+		batch.set_kpoints(kpt[start:end], weights=None if wgt is None else wgt[start:end])
+		batch_labels = [(i - start, name) for i, name in labels if start <= i < end]
+		if batch_labels:
+			batch.labels = batch_labels
+
+		res['batch_{:04d}'.format(n)] = batch
 
-	res.set_x(resX, x1[0], x1[2])
-	res.set_y(resYdata, resYnames, resYunits)
+	return res
+
+def _gaussian_dos(energies, eigs, weights, sigma, chunk_size=256):
+	"""
+	Gaussian broadened DOS of the eigenvalues 'eigs' with weights 'weights' on the grid 'energies'.
+	The grid is processed in blocks of 'chunk_size' energies, each one against only the eigenvalues
+	closer than 8 sigma.
+	"""
+	order = np.argsort(eigs)
+	eigs    = eigs[order]
+	weights = weights[order]
+
+	res = np.empty(len(energies))
+	for start in range(0, len(energies), chunk_size):
+		E  = energies[start:start+chunk_size]
+		lo = np.searchsorted(eigs, E[0] - 8*sigma, side='left')
+		hi = np.searchsorted(eigs, E[-1] + 8*sigma, side='right')
+
+		x = (E[:, np.newaxis] - eigs[np.newaxis, lo:hi]) / sigma
+		res[start:start+chunk_size] = np.exp(-x*x).dot(weights[lo:hi])
+
+	return res / (np.sqrt(np.pi) * sigma)
+
+@calcfunction
+def bands_to_dos(bands: orm.BandsData, parameters: orm.Dict, scf_parameters: orm.Dict) -> orm.XyData:
+	"""
+	Compute the DOS from the eigenvalues in 'bands' using gaussian broadening, as done by dos.x.
+	 - parameters: inputs of the DosCalculation. The 'DOS' namelist is used for 'degauss' (Ry, required),
+	           'DeltaE' (eV), 'Emin' (eV) and 'Emax' (eV). Only 'ngauss = 0' is supported.
+	 - scf_parameters: output parameters of pw.x, used to determine the spin degeneracy.
+	The output arrays follow the naming of the DosCalculation parser.
+	"""
+	namelists = {k.upper(): v for k,v in parameters.get_dict().items()}
+	dos_param = {k.lower(): v for k,v in namelists.get('DOS', {}).items()}
+	if dos_param.get('ngauss', 0) != 0:
+		raise ValueError('Only gaussian broadening (`ngauss = 0`) is supported')
+	if not 'degauss' in dos_param:
+		raise ValueError('`degauss` must be specified in the `DOS` namelist')
+
+	sigma  = dos_param['degauss'] * RY_TO_EV
+	deltae = dos_param.get('deltae', 0.01)
+
+	eigs = bands.get_bands()
+	_, wgt = _get_kpoints_weights(bands)
+	wgt = wgt / wgt.sum()
+	wgt = np.repeat(wgt, eigs.shape[-1])
+
+	emin = dos_param.get('emin', eigs.min() - 3*sigma)
+	emax = dos_param.get('emax', eigs.max() + 3*sigma)
+	energies = emin + np.arange(int(round((emax - emin) / deltae)) + 1) * deltae
+
+	if eigs.ndim == 3:
+		names = ['dos_spin_up', 'dos_spin_down']
+		dos = [_gaussian_dos(energies, e.flatten(), wgt, sigma) for e in eigs]
+	else:
+		scf_param = scf_parameters.get_dict()
+		noncolin = scf_param.get('non_colinear_calculation', False) or scf_param.get('spin_orbit_calculation', False)
+		degeneracy = 1 if noncolin else 2
+		names = ['dos']
+		dos = [degeneracy * _gaussian_dos(energies, eigs.flatten(), wgt, sigma)]
+
+	integrated = np.cumsum(np.sum(dos, axis=0)) * deltae
+
+	res = orm.XyData()
+	res.set_x(energies, 'dos_energy', 'eV')
+	res.set_y(dos + [integrated], names + ['integrated_dos'], ['states/eV'] * len(dos) + ['states'])
 
 	return res
 
@@ -8,6 +8,8 @@ from aiida.engine import WorkChain, ToContext, if_
 from aiida_quantumespresso.calculations.functions.seekpath_structure_analysis import seekpath_structure_analysis
 from aiida_quantumespresso.utils.mapping import prepare_process_inputs
 
+from .batched_pw import BatchedPwBaseWorkChain, get_batched_inputs
+
 PwBaseWorkChain = WorkflowFactory('quantumespresso.pw.base')
 PwRelaxWorkChain = WorkflowFactory('quantumespresso.pw.relax')
 
@@ -70,6 +72,8 @@ class MyPwBandsWorkChain(WorkChain):
             help='Explicit kpoints to use for the BANDS calculation. Specify either this or `bands_kpoints_distance`.')
         spec.input('bands_kpoints_distance', valid_type=orm.Float, required=False,
             help='Minimum kpoints distance for the BANDS calculation. Specify either this or `bands_kpoints`.')
+        spec.input('bands_batch_size', valid_type=orm.Int, required=False,
+            help='If specified, split the BANDS k-points in parallel batches of at most this size.')
         spec.input('parent_folder', valid_type=orm.RemoteData, required=False)
         spec.inputs.validator = validate_inputs
         spec.outline(
@@ -247,9 +251,13 @@ class MyPwBandsWorkChain(WorkChain):
             inputs.pw.parameters['SYSTEM'].setdefault('nbnd', self.ctx.current_number_of_bands)
 
         inputs = prepare_process_inputs(PwBaseWorkChain, inputs)
-        running = self.submit(PwBaseWorkChain, **inputs)
+        if 'bands_batch_size' in self.inputs:
+            inputs = get_batched_inputs(inputs, max_kpoints_per_batch=self.inputs.bands_batch_size)
+            running = self.submit(BatchedPwBaseWorkChain, **inputs)
+        else:
+            running = self.submit(PwBaseWorkChain, **inputs)
 
-        self.report(f'launching PwBaseWorkChain<{running.pk}> in bands mode')
+        self.report(f'launching {running.process_label}<{running.pk}> in bands mode')
 
         return ToContext(workchain_bands=running)
 
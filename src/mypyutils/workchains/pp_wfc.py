@@ -1,15 +1,51 @@
 from aiida import orm
 from aiida.common import AttributeDict
 from aiida.plugins import WorkflowFactory, CalculationFactory
-from aiida.engine import WorkChain, ToContext
+from aiida.engine import WorkChain, ToContext, append_
 
 from aiida_quantumespresso.utils.mapping import prepare_process_inputs
 
-from ..aiida import ListInputs_to_dict
+from ..aiida.inputs import nest_link_labels
 
 PwBaseWorkChain = WorkflowFactory('quantumespresso.pw.base')
 PpCalculation   = CalculationFactory('quantumespresso.pp')
 
+def get_output_nodes(node, link_types=('create', 'return')):
+    """Get the output nodes of `node` with a single query, as a nested dictionary by link label.
+
+    Only the node rows are fetched: array contents are not read from the repository.
+    """
+    qb = orm.QueryBuilder()
+    qb.append(orm.ProcessNode, filters={'id': node.pk}, tag='process')
+    qb.append(
+        orm.Node, with_incoming='process', project='*',
+        edge_filters={'type': {'in': list(link_types)}}, edge_project='label',
+        )
+
+    return nest_link_labels((label, out) for out, label in qb.iterall())
+
+def iter_wfc_data(node, arrays=None):
+    """Iterate over the wavefunction arrays in the `wfc_data` outputs of a PPwfcWorkChain, one array at a time.
+
+    Params:
+     - node: PPwfcWorkChain node.
+     - arrays: names of the arrays to read from every ArrayData. Default = all.
+    Yield:
+     (key, array name, array) with key being the label of the ArrayData inside `wfc_data`.
+    """
+    qb = orm.QueryBuilder()
+    qb.append(orm.WorkflowNode, filters={'id': node.pk}, tag='wc')
+    qb.append(
+        orm.ArrayData, with_incoming='wc', project='*', edge_tag='link',
+        edge_filters={'type': 'return', 'label': {'like': 'wfc_data\\_\\_%'}}, edge_project='label',
+        )
+    qb.order_by({'link': 'label'})
+
+    for data, label in qb.iterall(batch_size=100):
+        key = label.split('__', 1)[1]
+        for name in data.get_arraynames() if arrays is None else arrays:
+            yield key, name, data.get_array(name)
+
 class PPwfcWorkChain(WorkChain):
     """Workchain to calculate the wavefunction at a given set of kpoints."""
 
@@ -38,6 +74,10 @@ class PPwfcWorkChain(WorkChain):
             help='Smallest index, with respoect to the fermi level, of wavefunctions to compute.')
         spec.input('wavefunction_ef_max', valid_type=orm.Int, required=False,
             help='Largest index, with respoect to the fermi level, of wavefunctions to compute.')
+        spec.input('kpoints_per_shard', valid_type=orm.Int, required=False,
+            help='If specified, split the k-points range in shards of this size, run as concurrent `PpCalculation`s.')
+        spec.input('bands_per_shard', valid_type=orm.Int, required=False,
+            help='If specified, split the bands range in shards of this size, run as concurrent `PpCalculation`s.')
         spec.input('clean_workdir', valid_type=orm.Bool, default=lambda: orm.Bool(False),
             help='If `True`, work directories of all called calculation will be cleaned at the end of execution.')
         # spec.inputs.validator = validate_inputs
@@ -56,15 +96,19 @@ class PPwfcWorkChain(WorkChain):
             message='The scf PwBasexWorkChain sub process failed')
         spec.exit_code(403, 'ERROR_SUB_PROCESS_FAILED_NSCF',
             message='The nscf PwBasexWorkChain sub process failed')
+        spec.exit_code(204, 'ERROR_INVALID_INPUT_SHARD',
+            message='`kpoints_per_shard` and `bands_per_shard` must be positive integers.')
         spec.exit_code(404, 'ERROR_SUB_PROCESS_FAILED_PP',
             message='The PpCalculation sub process failed')
+        spec.exit_code(405, 'ERROR_MISSING_WFC_DATA',
+            message='A PpCalculation did not return any `output_data` or `output_data_multiple`')
 
         spec.output('scf_parameters', valid_type=orm.Dict,
             help='The output parameters of the SCF `PwBaseWorkChain`.')
         spec.output('nscf_parameters', valid_type=orm.Dict,
             help='The output parameters of the NSCF `PwBaseWorkChain`.')
         spec.output('pp_parameters', valid_type=orm.Dict,
-            help='The output parameters of the `PpCalculation`.')
+            help='The output parameters of the (first) `PpCalculation`.')
         spec.output_namespace('wfc_data', valid_type=orm.ArrayData, dynamic=True)
         # yapf: enable
 
@@ -74,6 +118,11 @@ class PPwfcWorkChain(WorkChain):
         self.ctx.current_structure = self.inputs.structure
         self.ctx.bands_kpoints = self.inputs.get('kpoints', None)
 
+        for key in ['kpoints_per_shard', 'bands_per_shard']:
+            if key in self.inputs and self.inputs[key].value <= 0:
+                self.report('`{}` must be a positive integer'.format(key))
+                return self.exit_codes.ERROR_INVALID_INPUT_SHARD
+
     def run_scf(self):
         """Run the PwBaseWorkChain in scf mode on the primitive cell of (optionally relaxed) input structure."""
         inputs = AttributeDict(self.exposed_inputs(PwBaseWorkChain, namespace='scf'))
@@ -153,18 +202,17 @@ class PPwfcWorkChain(WorkChain):
 
         self.ctx.current_folder = workchain.outputs.remote_folder
 
-    def run_pp(self):
-        """Run the PwBaseWorkChain in scf mode on the primitive cell of (optionally relaxed) input structure."""
-        inputs = AttributeDict(self.exposed_inputs(PpCalculation, namespace='pp'))
-        inputs.metadata.call_link_label = 'pp'
-        inputs.parent_folder = self.ctx.current_folder
+    @staticmethod
+    def get_shards(start, stop, size=None):
+        """Split the inclusive range `start`..`stop` in shards of at most `size` elements."""
+        if size is None:
+            return [(start, stop)]
+        return [(i, min(i + size - 1, stop)) for i in range(start, stop + 1, size)]
 
+    def run_pp(self):
+        """Run the PpCalculation(s) to extract the wavefunctions, optionally sharded by k-points and bands."""
         nscf_params = self.ctx.workchain_nscf.outputs.output_parameters
 
-        inputs.parameters = inputs.parameters.get_dict()
-        inputs.parameters.setdefault('INPUTPP', {})
-        inputs.parameters.setdefault('PLOT', {})
-        inputs.parameters['INPUTPP']['plot_num'] = 7
         nel = int(nscf_params['number_of_electrons'])
         if 'wavefunction_min' in self.inputs:
             kband_min = self.inputs.wavefunction_min.value
@@ -184,28 +232,48 @@ class PPwfcWorkChain(WorkChain):
             else:
                 kband_max = nscf_params['number_of_atomic_wfc']
 
-        inputs.parameters['INPUTPP']['kband(1)'] = kband_min
-        inputs.parameters['INPUTPP']['kband(2)'] = kband_max
-        inputs.parameters['INPUTPP']['kpoint(1)'] = 1
-        inputs.parameters['INPUTPP']['kpoint(2)'] = nscf_params['number_of_k_points']
-
-        inputs.parameters['PLOT']['iflag'] = 3
-        # inputs.parameters['PLOT']['output_format'] = 5
-
-        inputs = prepare_process_inputs(PpCalculation, inputs)
-        running = self.submit(PpCalculation, **inputs)
-
-        self.report(f'launching PpCalculation<{running.pk}>')
-
-        return ToContext(workchain_pp=running)
+        k_size = self.inputs.kpoints_per_shard.value if 'kpoints_per_shard' in self.inputs else None
+        b_size = self.inputs.bands_per_shard.value if 'bands_per_shard' in self.inputs else None
+        k_shards = self.get_shards(1, nscf_params['number_of_k_points'], k_size)
+        b_shards = self.get_shards(kband_min, kband_max, b_size)
+        n_shards = len(k_shards) * len(b_shards)
+        self.ctx.pp_shards = []
+
+        for (kpt_1, kpt_2) in k_shards:
+            for (kband_1, kband_2) in b_shards:
+                inputs = AttributeDict(self.exposed_inputs(PpCalculation, namespace='pp'))
+                if n_shards == 1:
+                    inputs.metadata.call_link_label = 'pp'
+                else:
+                    inputs.metadata.call_link_label = f'pp_k{kpt_1}_{kpt_2}_b{kband_1}_{kband_2}'
+                inputs.parent_folder = self.ctx.current_folder
+
+                inputs.parameters = inputs.parameters.get_dict()
+                inputs.parameters.setdefault('INPUTPP', {})
+                inputs.parameters.setdefault('PLOT', {})
+                inputs.parameters['INPUTPP']['plot_num'] = 7
+
+                inputs.parameters['INPUTPP']['kband(1)'] = kband_1
+                inputs.parameters['INPUTPP']['kband(2)'] = kband_2
+                inputs.parameters['INPUTPP']['kpoint(1)'] = kpt_1
+                inputs.parameters['INPUTPP']['kpoint(2)'] = kpt_2
+
+                inputs.parameters['PLOT']['iflag'] = 3
+                # inputs.parameters['PLOT']['output_format'] = 5
+
+                inputs = prepare_process_inputs(PpCalculation, inputs)
+                running = self.submit(PpCalculation, **inputs)
+
+                self.report(f'launching PpCalculation<{running.pk}> for k-points {kpt_1}-{kpt_2}, bands {kband_1}-{kband_2}')
+                self.ctx.pp_shards.append((kpt_1, kpt_2, kband_1, kband_2))
+                self.to_context(workchain_pp=append_(running))
 
     def inspect_pp(self):
-        """Verify that the PwBaseWorkChain for the scf run finished successfully."""
-        workchain = self.ctx.workchain_pp
-
-        if not workchain.is_finished_ok:
-            self.report(f'PpCalculation failed with exit status {workchain.exit_status}')
-            return self.exit_codes.ERROR_SUB_PROCESS_FAILED_PP
+        """Verify that the PpCalculations finished successfully."""
+        for workchain in self.ctx.workchain_pp:
+            if not workchain.is_finished_ok:
+                self.report(f'PpCalculation<{workchain.pk}> failed with exit status {workchain.exit_status}')
+                return self.exit_codes.ERROR_SUB_PROCESS_FAILED_PP
 
     def results(self):
         """Attach the desired output nodes directly as outputs of the workchain."""
@@ -213,9 +281,28 @@ class PPwfcWorkChain(WorkChain):
         self.out('scf_parameters', self.ctx.workchain_scf.outputs.output_parameters)
         self.out('nscf_parameters', self.ctx.workchain_nscf.outputs.output_parameters)
 
-        output_dct = ListInputs_to_dict(self.ctx.workchain_pp.outputs)
-        self.out('pp_parameters', output_dct['output_parameters'])
-        self.out('wfc_data', output_dct['output_data_multiple'])
+        wfc_data = {}
+        for n, (workchain, shard) in enumerate(zip(self.ctx.workchain_pp, self.ctx.pp_shards)):
+            output_dct = get_output_nodes(workchain)
+            if n == 0:
+                self.out('pp_parameters', output_dct['output_parameters'])
+
+            # A single plot file is returned by the parser as `output_data`
+            if 'output_data_multiple' in output_dct:
+                data = output_dct['output_data_multiple']
+            elif 'output_data' in output_dct:
+                kpt_1, _, kband_1, _ = shard
+                data = {f'K{kpt_1:03d}_B{kband_1:03d}': output_dct['output_data']}
+            else:
+                self.report(f'PpCalculation<{workchain.pk}> returned no wavefunction data')
+                return self.exit_codes.ERROR_MISSING_WFC_DATA
+
+            for key, node in data.items():
+                if key in wfc_data:
+                    key = f'{workchain.label or workchain.pk}_{key}'
+                wfc_data[key] = node
+
+        self.out('wfc_data', wfc_data)
 
     def on_terminated(self):
         """Clean the working directories of all child calculations if `clean_workdir=True` in the inputs."""
@@ -0,0 +1,6 @@
+"""Shared fixtures: a temporary AiiDA profile, if aiida-core is available."""
+from importlib.util import find_spec
+
+pytest_plugins = []
+if find_spec('aiida') is not None and find_spec('aiida.tools.pytest_fixtures') is not None:
+    pytest_plugins.append('aiida.tools.pytest_fixtures')
@@ -0,0 +1,149 @@
+"""Tests for the nested dictionaries utilities."""
+import pytest
+
+from mypyutils.dict import deep_copy, deep_update, FrozenDict
+
+def make_params():
+    return {
+        'CONTROL': {'calculation': 'scf', 'tprnfor': True},
+        'SYSTEM': {'ecutwfc': 40, 'hubbard': {'U': {'Fe': 4.0}, 'J': {'Fe': 0.5}}},
+        'ELECTRONS': {'conv_thr': 1e-8},
+        'kpoints': [4, 4, 4],
+        }
+
+def test_deep_copy():
+    old = make_params()
+    res = deep_copy(old)
+
+    assert res == old
+    assert res is not old
+    assert res['SYSTEM'] is not old['SYSTEM']
+    assert res['SYSTEM']['hubbard']['U'] is not old['SYSTEM']['hubbard']['U']
+    # Non-dict values are not copied
+    assert res['kpoints'] is old['kpoints']
+
+    res['SYSTEM']['hubbard']['U']['Fe'] = 5.0
+    assert old['SYSTEM']['hubbard']['U']['Fe'] == 4.0
+
+def test_deep_copy_deep():
+    old = leaf = {}
+    for i in range(5000):
+        leaf['sub'] = {'i': i}
+        leaf = leaf['sub']
+
+    res = deep_copy(old)
+    assert res['sub']['sub'] is not old['sub']['sub']
+
+def test_deep_update_overwrite():
+    old = make_params()
+    system = old['SYSTEM']
+    res = deep_update(old, {'SYSTEM': {'hubbard': {'U': {'Fe': 5.0}}, 'nbnd': 20}})
+
+    assert res is old
+    assert res['SYSTEM'] is system
+    assert res['SYSTEM']['hubbard']['U'] == {'Fe': 5.0}
+    assert res['SYSTEM']['hubbard']['J'] == {'Fe': 0.5}
+    assert res['SYSTEM']['nbnd'] == 20
+
+def test_deep_update_shared_paths():
+    """Only the dictionaries along the updated paths are copied, the others are shared with `old`."""
+    old = make_params()
+    ref = deep_copy(old)
+    res = deep_update(old, {'SYSTEM': {'hubbard': {'U': {'Fe': 5.0}}}}, overwrite=False)
+
+    assert old == ref
+    assert res == deep_update(deep_copy(ref), {'SYSTEM': {'hubbard': {'U': {'Fe': 5.0}}}})
+
+    # Copied along the path
+    assert res is not old
+    assert res['SYSTEM'] is not old['SYSTEM']
+    assert res['SYSTEM']['hubbard'] is not old['SYSTEM']['hubbard']
+    assert res['SYSTEM']['hubbard']['U'] is not old['SYSTEM']['hubbard']['U']
+    # Shared outside of it
+    assert res['CONTROL'] is old['CONTROL']
+    assert res['ELECTRONS'] is old['ELECTRONS']
+    assert res['SYSTEM']['hubbard']['J'] is old['SYSTEM']['hubbard']['J']
+
+@pytest.mark.parametrize('new', [
+    {'SYSTEM': 'none'},
+    {'CONTROL': {'calculation': {'mode': 'nscf'}}},
+    {'new': {'a': {'b': 1}}},
+    {},
+    ])
+def test_deep_update_replace(new):
+    """Dictionaries replacing other values (and vice versa) are assigned as they are."""
+    old = make_params()
+    ref = deep_copy(old)
+
+    res = deep_update(old, new, overwrite=False)
+    assert old == ref
+    assert res == deep_update(deep_copy(ref), new)
+    for k, v in new.items():
+        if not isinstance(ref.get(k, None), dict) or not isinstance(v, dict):
+            assert res[k] is v
+
+def test_frozen_dict_convert():
+    frz = FrozenDict(make_params())
+
+    assert isinstance(frz['SYSTEM'], FrozenDict)
+    assert isinstance(frz['SYSTEM']['hubbard']['U'], FrozenDict)
+    assert frz['kpoints'] == (4, 4, 4)
+    assert frz == make_params()
+    assert frz.to_dict() == make_params()
+    with pytest.raises(TypeError):
+        frz['CONTROL'] = {}
+
+def test_frozen_dict_hash():
+    frz = FrozenDict(make_params())
+    assert hash(frz) == hash(FrozenDict(make_params()))
+    assert frz == FrozenDict(make_params())
+    assert frz != frz.with_path(('SYSTEM', 'ecutwfc'), 50)
+    assert {frz: 1}[FrozenDict(make_params())] == 1
+    # The cached hash of the original is not affected by the new maps
+    h = hash(frz)
+    frz.with_path(('SYSTEM', 'ecutwfc'), 50)
+    assert hash(frz) == h
+
+def test_frozen_dict_with_path():
+    frz = FrozenDict(make_params())
+    res = frz.with_path(('SYSTEM', 'hubbard', 'U', 'Fe'), 5.0)
+
+    assert frz.get_path(('SYSTEM', 'hubbard', 'U', 'Fe')) == 4.0
+    assert res.get_path(('SYSTEM', 'hubbard', 'U', 'Fe')) == 5.0
+    assert res == deep_update(make_params(), {'SYSTEM': {'hubbard': {'U': {'Fe': 5.0}}}})
+    # Copied along the path, shared outside of it
+    assert res['SYSTEM'] is not frz['SYSTEM']
+    assert res['SYSTEM']['hubbard']['U'] is not frz['SYSTEM']['hubbard']['U']
+    assert res['CONTROL'] is frz['CONTROL']
+    assert res['SYSTEM']['hubbard']['J'] is frz['SYSTEM']['hubbard']['J']
+
+    res = frz.with_path(('new', 'a', 'b'), {'c': [1]})
+    assert res.get_path(('new', 'a', 'b', 'c')) == (1,)
+    assert res['ELECTRONS'] is frz['ELECTRONS']
+    assert frz.with_path('kpoints', [2, 2, 2])['kpoints'] == (2, 2, 2)
+    with pytest.raises(ValueError):
+        frz.with_path((), 1)
+
+def test_frozen_dict_without_path():
+    frz = FrozenDict(make_params())
+    res = frz.without_path(('SYSTEM', 'hubbard', 'J'))
+
+    assert 'J' not in res['SYSTEM']['hubbard']
+    assert 'J' in frz['SYSTEM']['hubbard']
+    assert res['SYSTEM']['hubbard']['U'] is frz['SYSTEM']['hubbard']['U']
+    assert res['CONTROL'] is frz['CONTROL']
+    # Missing paths return the same map
+    assert frz.without_path(('SYSTEM', 'nbnd')) is frz
+    assert frz.without_path(('kpoints', 'a')) is frz
+    assert frz.without_path('missing') is frz
+
+def test_frozen_dict_merge():
+    frz = FrozenDict(make_params())
+    new = {'SYSTEM': {'hubbard': {'U': {'Fe': 5.0}}, 'nbnd': 20}, 'CONTROL': 'replaced'}
+    res = frz.merge(new)
+
+    assert res == deep_update(make_params(), new)
+    assert frz == make_params()
+    assert res['ELECTRONS'] is frz['ELECTRONS']
+    assert res['SYSTEM']['hubbard']['J'] is frz['SYSTEM']['hubbard']['J']
+    assert frz.merge(FrozenDict(new)) == res
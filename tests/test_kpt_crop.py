@@ -0,0 +1,69 @@
+"""Tests for the chunked `_kpt_crop` mask against the original set-based selection."""
+import numpy as np
+import pytest
+
+pytest.importorskip('aiida')
+pytest.importorskip('aiida_quantumespresso')
+
+from mypyutils.workchains.kpoint_grids import _kpt_crop
+
+def legacy_crop(kpt_cart, centers, radii, anticrop=False):
+    """Index selection of the original `_kpt_crop`, one set operation per center."""
+    index = set()
+    for center, radius in zip(np.array(centers).reshape(-1, 3), radii):
+        norms = np.linalg.norm(kpt_cart - center, axis=1)
+        if not anticrop:
+            index = index.union(set(np.where(norms <= radius)[0]))
+        else:
+            w = np.where(norms > radius)[0]
+            if not index:
+                index = index.union(set(w))
+            else:
+                index = index.intersection(set(w))
+    return np.array(sorted(index), dtype=int)
+
+@pytest.fixture
+def mesh():
+    rng    = np.random.default_rng(0)
+    recipr = np.eye(3) + rng.uniform(-0.2, 0.2, (3, 3))
+    kpt    = rng.random((1000, 3))
+    weight = rng.random(1000)
+    return kpt, recipr, weight
+
+def crop_index(kpt_cart, res_kpt):
+    """Indexes of the rows of `res_kpt` in `kpt_cart`."""
+    return np.array([np.where((kpt_cart == k).all(axis=1))[0][0] for k in res_kpt], dtype=int)
+
+@pytest.mark.parametrize('chunk_size', [1, 7, 999, 1000, 1001, 10**6])
+@pytest.mark.parametrize('anticrop', [False, True])
+def test_crop(mesh, chunk_size, anticrop):
+    kpt, recipr, weight = mesh
+    kpt_cart = kpt.dot(recipr)
+    rng      = np.random.default_rng(chunk_size)
+    centers  = rng.random((5, 3)).dot(recipr)
+    radii    = list(rng.uniform(0.1, 0.4, 5))
+
+    res_kpt, res_weight = _kpt_crop(kpt, recipr, weight, centers, radii, anticrop=anticrop, chunk_size=chunk_size)
+    ref = legacy_crop(kpt_cart, centers, radii, anticrop=anticrop)
+
+    assert len(ref) and len(ref) < len(kpt)
+    np.testing.assert_array_equal(crop_index(kpt_cart, res_kpt), ref)
+    np.testing.assert_allclose(res_weight, weight[ref] / weight.sum())
+
+@pytest.mark.parametrize('chunk_size', [1, 1000, 1001])
+def test_anticrop_empty_intersection(mesh, chunk_size):
+    """The original code restarted from the next center once the intersection became empty.
+
+    The mask keeps only the points outside of all the spheres, so a sphere containing the whole
+    grid leaves nothing to select.
+    """
+    kpt, recipr, weight = mesh
+    kpt_cart = kpt.dot(recipr)
+    centers  = [[0.5, 0.5, 0.5], [0.1, 0.1, 0.1]]
+    radii    = [10.0, 0.2]
+
+    res_kpt, _ = _kpt_crop(kpt_cart, centers=centers, radii=radii, anticrop=True, chunk_size=chunk_size)
+    ref = legacy_crop(kpt_cart, centers, radii, anticrop=True)
+
+    assert len(res_kpt) == 0
+    assert len(ref) > 0
@@ -0,0 +1,48 @@
+"""Tests for splitting explicit k-points lists in batches."""
+import numpy as np
+import pytest
+
+pytest.importorskip('aiida')
+pytest.importorskip('aiida_quantumespresso')
+
+from aiida import orm
+
+from mypyutils.workchains.batched_pw import validate_kpoints
+from mypyutils.workchains.dos import has_explicit_kpoints
+from mypyutils.workchains.kpoint_grids import kpt_split
+
+@pytest.fixture
+def kpt_mesh(aiida_profile):
+    res = orm.KpointsData()
+    res.set_cell(np.eye(3))
+    res.set_kpoints_mesh([4, 4, 4])
+    return res
+
+@pytest.fixture
+def kpt_list(aiida_profile):
+    res = orm.KpointsData()
+    res.set_cell(np.eye(3))
+    res.set_kpoints(np.random.default_rng(0).random((10, 3)), weights=np.full(10, 0.1))
+    return res
+
+def test_mesh_get_kpoints(kpt_mesh):
+    """A mesh has no explicit list, which is what the batches used to rely on."""
+    with pytest.raises(AttributeError):
+        kpt_mesh.get_kpoints()
+
+def test_mesh_rejected(kpt_mesh):
+    assert not has_explicit_kpoints(kpt_mesh)
+    assert validate_kpoints(kpt_mesh) is not None
+    with pytest.raises(ValueError):
+        kpt_split(kpt_mesh, orm.Int(10))
+
+def test_list_split(kpt_list):
+    assert has_explicit_kpoints(kpt_list)
+    assert validate_kpoints(kpt_list) is None
+
+    batches = kpt_split(kpt_list, orm.Int(4))
+    assert sorted(batches) == ['batch_0000', 'batch_0001', 'batch_0002']
+    assert sum(len(b.get_kpoints()) for b in batches.values()) == 10
+
+    kpt = np.vstack([batches[k].get_kpoints() for k in sorted(batches)])
+    np.testing.assert_allclose(kpt, kpt_list.get_kpoints())
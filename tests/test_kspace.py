@@ -0,0 +1,72 @@
+"""Tests for the periodic k-points KD-tree."""
+import numpy as np
+import pytest
+
+from mypyutils.kspace import PeriodicKTree
+
+@pytest.fixture
+def grid():
+    rng    = np.random.default_rng(0)
+    recipr = np.eye(3) * 2 + rng.uniform(-0.3, 0.3, (3, 3))
+    kpt    = rng.random((2000, 3)).dot(recipr)
+    return kpt, recipr
+
+def brute_force(kpt, recipr, center, r):
+    """Points within the minimum image distance `r` from `center`, checking the 27 neighbouring cells explicitly."""
+    cryst  = np.dot(center, np.linalg.inv(recipr))
+    center = (cryst - np.floor(cryst)).dot(recipr)
+    shifts = np.array([[i, j, k] for i in (-1, 0, 1) for j in (-1, 0, 1) for k in (-1, 0, 1)]).dot(recipr)
+    diff   = kpt[:, np.newaxis, :] - center - shifts[np.newaxis, :, :]
+    dist   = np.linalg.norm(diff, axis=-1).min(axis=1)
+    return np.where(dist <= r)[0]
+
+def test_face_wrap(grid):
+    """A sphere centered near the k=0 face also contains the points near the k=1 face."""
+    kpt, recipr = grid
+    tree   = PeriodicKTree(kpt, recipr)
+    center = np.array([0.01, 0.5, 0.5]).dot(recipr)
+
+    found = tree.query_ball_point(center, 0.3)[0]
+    cryst = kpt.dot(np.linalg.inv(recipr))
+
+    assert (cryst[found, 0] > 0.5).any()
+    assert (cryst[found, 0] < 0.5).any()
+    np.testing.assert_array_equal(found, brute_force(kpt, recipr, center, 0.3))
+
+def test_query_ball_point(grid):
+    kpt, recipr = grid
+    tree    = PeriodicKTree(kpt, recipr)
+    rng     = np.random.default_rng(1)
+    centers = rng.uniform(-1, 2, (10, 3)).dot(recipr)
+    radii   = rng.uniform(0.05, 0.5, 10)
+
+    for center, r, found in zip(centers, radii, tree.query_ball_point(centers, radii)):
+        np.testing.assert_array_equal(found, brute_force(kpt, recipr, center, r))
+
+def test_large_radius(grid):
+    """Radii larger than the cell select every point, also when mixed with regular ones."""
+    kpt, recipr = grid
+    tree    = PeriodicKTree(kpt, recipr)
+    centers = np.array([[0.2, 0.3, 0.9], [0.5, 0.5, 0.5], [3.0, -1.0, 0.5]])
+    radii   = [tree.diameter, 0.2, 174.0]
+
+    found = tree.query_ball_point(centers, radii)
+    np.testing.assert_array_equal(found[0], np.arange(len(kpt)))
+    np.testing.assert_array_equal(found[1], brute_force(kpt, recipr, centers[1], 0.2))
+    np.testing.assert_array_equal(found[2], np.arange(len(kpt)))
+
+    # Just below the diameter the images are still queried, finding all the points anyway
+    found = tree.query_ball_point(centers[0], tree.diameter * 0.999)[0]
+    np.testing.assert_array_equal(found, np.arange(len(kpt)))
+
+def test_query(grid):
+    kpt, recipr = grid
+    tree   = PeriodicKTree(kpt, recipr)
+    center = np.array([0.999, 0.001, 0.5]).dot(recipr)
+
+    dist, idx = tree.query(center)
+    shifts = np.array([[i, j, k] for i in (-1, 0, 1) for j in (-1, 0, 1) for k in (-1, 0, 1)]).dot(recipr)
+    ref    = np.linalg.norm(kpt[:, np.newaxis, :] - center - shifts, axis=-1).min(axis=1)
+
+    assert idx[0] == ref.argmin()
+    np.testing.assert_allclose(dist[0], ref.min())
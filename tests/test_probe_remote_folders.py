@@ -0,0 +1,52 @@
+"""Tests for the grouping and classification of `probe_remote_folders`, using a local transport stand-in."""
+import pytest
+
+pytest.importorskip('aiida')
+
+from aiida.transports.plugins.local import LocalTransport
+
+from mypyutils.aiida.utils import classify_remote_folders
+
+class CountingTransport(LocalTransport):
+    """LocalTransport recording how many times it is opened."""
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.n_open = 0
+
+    def open(self):
+        self.n_open += 1
+        return super().open()
+
+@pytest.fixture
+def folders(tmp_path):
+    res = {}
+    for name, files in [('running', ['aiida.out', 'aiida.in']), ('queued', ['aiida.in']), ('empty', [])]:
+        path = tmp_path / name
+        path.mkdir()
+        for f in files:
+            (path / f).write_text('')
+        res[name] = str(path)
+    res['missing'] = str(tmp_path / 'missing')
+    return res
+
+def test_classify_remote_folders(folders):
+    jobs = {
+        'computer_a': [
+            (1, folders['running'], 'aiida.out'),
+            (2, folders['queued'], 'aiida.out'),
+            ],
+        'computer_b': [
+            (3, folders['empty'], 'aiida.out'),
+            (4, folders['missing'], 'aiida.out'),
+            (5, folders['running'], 'aiida.in'),
+            ],
+        }
+    transports = {key: CountingTransport() for key in jobs}
+
+    res = classify_remote_folders(jobs, transports, max_workers=2)
+
+    assert res == {1: 'running', 2: 'queued', 3: 'queued', 4: 'error', 5: 'running'}
+    assert all(t.n_open == 1 for t in transports.values())
+
+def test_classify_remote_folders_empty():
+    assert classify_remote_folders({}, {}) == {}
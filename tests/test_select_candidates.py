@@ -0,0 +1,53 @@
+"""Tests for the closed-form selection of the crossing candidates against the original shrinking loop."""
+import numpy as np
+import pytest
+
+pytest.importorskip('aiida')
+pytest.importorskip('matplotlib')
+
+from mypyutils.aiida.analyze_FindCrossingsWorkChain import _select_candidates
+
+def legacy_select(gq, min_gap, scale, lim):
+    """Original loop of `_analyze_FindCrossingsWorkChain`."""
+    app = None
+    while app is None or len(app) > lim:
+        app = np.where(gq < min_gap * scale)[0]
+        scale *= 0.98
+        if scale < 1.0001:
+            app = np.where(gq < min_gap * 1.0001)[0]
+            break
+    return app
+
+def check(gq, min_gap, scale, lim):
+    with np.errstate(invalid='ignore'):
+        ref = legacy_select(gq, min_gap, scale, lim)
+        res = _select_candidates(gq, min_gap, scale, lim)
+    np.testing.assert_array_equal(res, ref)
+
+@pytest.mark.parametrize('seed', range(20))
+def test_random(seed):
+    rng = np.random.default_rng(seed)
+    gq = rng.exponential(0.1, rng.integers(1, 2000))
+    min_gap = gq.min() if rng.random() < 0.8 else 0.0
+    check(gq, min_gap, rng.uniform(1, 50), int(rng.integers(1, 200)))
+
+@pytest.mark.parametrize('scale', [1.0001, 1.0001 / 0.98, 1.00005])
+def test_scale_min(scale):
+    gq = np.random.default_rng(1).uniform(0.01, 0.02, 500)
+    check(gq, 0.01, scale, 10)
+
+@pytest.mark.parametrize('lim', [100, 500, 1000])
+def test_few_gaps(lim):
+    gq = np.random.default_rng(2).uniform(0.01, 1, 100)
+    check(gq, 0.01, 20, lim)
+
+@pytest.mark.parametrize('n', [10, 1000])
+def test_zero_gap_inf_scale(n):
+    gq = np.random.default_rng(3).uniform(0, 1, n)
+    gq[0] = 0
+    check(gq, 0.0, np.inf, 50)
+
+def test_ties():
+    gq = np.repeat([0.01, 0.02, 0.03], 40)
+    for lim in [0, 39, 40, 80, 119, 120]:
+        check(gq, 0.01, 3.5, lim)
@@ -0,0 +1,49 @@
+"""Tests for the node and file helpers shared by the aiida utilities."""
+import os
+
+import pytest
+
+pytest.importorskip('aiida')
+
+from aiida import orm
+
+from mypyutils.aiida.utils import get_pks, atomic_open
+
+def test_get_pks(aiida_profile):
+    nodes = [orm.Int(i).store() for i in range(3)]
+    pks   = [n.pk for n in nodes]
+
+    group = orm.Group(label='test_get_pks').store()
+    group.add_nodes(nodes)
+
+    assert get_pks(nodes) == pks
+    assert get_pks([str(pk) for pk in pks]) == pks
+    assert get_pks(pks[:1] + nodes[1:]) == pks
+    assert sorted(get_pks(group)) == pks
+    assert get_pks(group, orm.ProcessNode) == []
+
+    qb = orm.QueryBuilder().append(orm.Int, filters={'id': {'in': pks}}, project='id')
+    assert sorted(get_pks(qb)) == pks
+    qb = orm.QueryBuilder().append(orm.Int, filters={'id': {'in': pks}})
+    assert sorted(get_pks(qb)) == pks
+
+def test_atomic_open(tmp_path):
+    fname = str(tmp_path / 'sub' / 'data.json')
+    with atomic_open(fname) as f:
+        f.write('old')
+        assert not os.path.exists(fname)
+    with open(fname) as f:
+        assert f.read() == 'old'
+
+    with pytest.raises(RuntimeError):
+        with atomic_open(fname) as f:
+            f.write('new')
+            raise RuntimeError('failed')
+    with open(fname) as f:
+        assert f.read() == 'old'
+    assert os.listdir(os.path.dirname(fname)) == ['data.json']
+
+    with atomic_open(fname, 'wb') as f:
+        f.write(b'new')
+    with open(fname) as f:
+        assert f.read() == 'new'